@@ -1,164 +1,3713 @@
 import sys
 import os
 import json
-from datetime import datetime
+import bisect
+import difflib
+import mmap
+from collections import OrderedDict
+import hashlib
+import heapq
+import math
+import re
+import shutil
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+from array import array
+from html import unescape
+from html.parser import HTMLParser
+from itertools import compress
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.parse import unquote, urlsplit
+import multiprocessing
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QTextEdit, QVBoxLayout, QHBoxLayout, QPushButton, 
-    QWidget, QLineEdit, QFrame, QLabel, QScrollArea, QDialog, QToolBar, QColorDialog, 
-    QMenu, QMessageBox, QSlider, QFileDialog
+    QWidget, QLineEdit, QLabel, QScrollArea, QDialog, QToolBar, QColorDialog, 
+    QMenu, QMessageBox, QSlider, QFileDialog, QListView, QStyledItemDelegate, QStyle,
+    QAbstractItemView
+)
+from PyQt5.QtCore import (
+    Qt, QSize, QRect, QTimer, QThread, QObject, pyqtSignal, pyqtSlot, QByteArray, QMimeData,
+    QAbstractListModel, QModelIndex, QRunnable, QThreadPool
 )
-from PyQt5.QtCore import Qt, QSize, pyqtSignal, QByteArray, QMimeData, QUrl
 from PyQt5.QtGui import (
-    QIcon, QFont, QTextCharFormat, QColor, QDrag, QCursor, QPixmap, QTextDocument, QTextImageFormat
+    QIcon, QFont, QTextCharFormat, QColor, QDrag, QCursor, QPixmap, QTextDocument, QTextImageFormat,
+    QPainter, QPen, QImage, QImageReader, QTextCursor
 )
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    # 没有安装 Pillow 时插入的图片原样保存
+    Image = None
+
+# 变更日志超过该大小且超过待重写分片的大小时，合并为新的快照
+JOURNAL_COMPACT_BYTES = 1024 * 1024
+# JSON 后端的快照按便签ID分片，每个分片保存该数量的连续ID，合并时只重写有变更的分片
+SHARD_NOTES = 4096
+
+# 合并该时间窗口（秒）内的连续修改后再写入磁盘
+SAVE_DELAY = 0.3
+# 写入失败后的重试间隔（秒）
+SAVE_RETRY_DELAY = 5
+
+# 搜索框停止输入该时间（毫秒）后才执行查询
+SEARCH_DELAY_MS = 150
+# 状态栏提示显示的时间（毫秒），之后状态栏隐藏
+STATUS_MESSAGE_MS = 8000
+
+# 正文编码后超过该字节数时用 zlib 压缩保存，为 None 时不压缩
+CONTENT_COMPRESS_BYTES = 1024
+
+# 启动时每次加载的便签数量，第一页加载后即显示窗口
+LOAD_PAGE_SIZE = 100
+
+# 默认存储后端：'json' 或 'sqlite'（数据目录中已有 notes.db 时总是使用 sqlite）
+STORAGE_BACKEND = 'json'
+
+# 预览摘要的最大长度
+PREVIEW_LENGTH = 120
+# 空闲时每批补全纯文本字段的便签数量
+BACKFILL_CHUNK = 200
+# 退出时保存搜索索引，下次启动无需重建
+SEARCH_INDEX_PERSIST = True
+# 内存中保留正文的便签数量上限，其余便签只保留元数据，正文在打开或搜索时读取
+BODY_CACHE_SIZE = 64
+# 计算图片哈希时每次读取的字节数
+IMAGE_HASH_CHUNK = 1024 * 1024
+# 内存中缓存的缩略图总大小上限（字节）
+THUMB_CACHE_BYTES = 64 * 1024 * 1024
+# 编辑器中图片和卡片预览图的最大边长
+EDITOR_IMAGE_SIZE = 200
+CARD_IMAGE_SIZE = 40
+# 后台解码图片的线程数
+IMAGE_LOAD_THREADS = 2
+# 插入图片时长边超过该像素数则缩小，并按以下格式（'webp' 或 'jpeg'）和质量重新压缩
+INGEST_MAX_DIMENSION = 2560
+INGEST_FORMAT = 'webp'
+INGEST_QUALITY = 85
+# 是否在 images/originals 中保留插入前的原图
+INGEST_KEEP_ORIGINAL = False
+# 处理插入图片的进程数
+INGEST_PROCESSES = 2
+# 删除超过该天数的便签在后台清理时永久删除
+GC_RETENTION_DAYS = 30
+# 清理图片时跳过该时间（秒）内修改过的文件，编辑中尚未保存的便签可能正在使用它们
+GC_IMAGE_GRACE = 24 * 3600
+# 修订历史每隔该数量的修订保存一次完整内容，其余只保存与上一个修订的差异
+HISTORY_KEYFRAME_INTERVAL = 16
+# 该天数内的修订全部保留，更早的每天只保留最后一个，超过 HISTORY_DAILY_DAYS 天的每周只保留最后一个
+HISTORY_KEEP_ALL_DAYS = 7
+HISTORY_DAILY_DAYS = 90
+# 按相关度排序时最多显示的结果数量
+SEARCH_RANK_LIMIT = 100
+# BM25 参数，标题中的命中按 TITLE_WEIGHT 倍计入词频
+BM25_K1 = 1.2
+BM25_B = 0.75
+TITLE_WEIGHT = 3.0
+
+class HtmlTextExtractor(HTMLParser):
+    """从 QTextEdit.toHtml() 的输出中提取正文纯文本"""
+    SKIP_TAGS = ('head', 'style', 'script', 'title')
+    BLOCK_TAGS = ('p', 'div', 'br', 'li', 'tr', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'pre')
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self.skip += 1
+        elif tag in self.BLOCK_TAGS and self.parts:
+            self.parts.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS and self.skip:
+            self.skip -= 1
+
+    def handle_data(self, data):
+        # 块级标签之间的换行缩进只是 HTML 排版，不属于正文
+        if not self.skip and (data.strip() or '\n' not in data):
+            self.parts.append(data)
+
+def html_to_text(content):
+    if '<' not in content:
+        return content.strip()
+    extractor = HtmlTextExtractor()
+    extractor.feed(content)
+    extractor.close()
+    lines = ''.join(extractor.parts).replace('\xa0', ' ').split('\n')
+    return '\n'.join(line.rstrip() for line in lines).strip()
+
+def format_bytes(size):
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return f'{size:.0f} {unit}' if unit == 'B' else f'{size:.1f} {unit}'
+        size /= 1024
+    return f'{size:.1f} GB'
+
+def make_preview(plain_text):
+    # 合并空白后截取开头部分，卡片只显示两行左右
+    return ' '.join(plain_text.split())[:PREVIEW_LENGTH]
+
+# 正文字段：单独存放，按需读取；其余字段为常驻内存的元数据
+BODY_FIELDS = ('content', 'plain_text')
+# 由正文派生、保存在元数据中的字段，启动时不必读取正文
+DERIVED_FIELDS = ('preview', 'images', 'text_crc')
+
+def split_body(fields):
+    # 返回 (元数据字段, 正文字段)
+    meta = {k: v for k, v in fields.items() if k not in BODY_FIELDS}
+    body = {k: v for k, v in fields.items() if k in BODY_FIELDS}
+    return meta, body
+
+class ContentCodec:
+    """正文 HTML（QTextEdit.toHtml() 的输出）的紧凑存储格式
+
+    去掉 Qt 固定的文件头和结尾，只保留 body 的字体和字号；style 属性替换为引用，
+    Qt 常用的段落和字符样式在内置的 STYLES 中，同一正文中重复出现的其他样式只保存一次。
+    编码后为 MARK '1' 字体\x02字号 \x01 样式表 \x01 正文，引用为 \x02序号\x03（内置样式）
+    或 \x04序号\x03（样式表）。解码得到与编码前完全相同的字符串，不是这种格式的内容
+    （旧数据、纯文本）原样返回。
+    """
+    MARK = '\x01'
+    # 含有这些控制字符的内容不做转换
+    RESERVED = re.compile('[\x01-\x04]')
+    HEAD = ('<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.0//EN" '
+            '"http://www.w3.org/TR/REC-html40/strict.dtd">\n'
+            '<html><head><meta name="qrichtext" content="1" /><style type="text/css">\n'
+            'p, li {{ white-space: pre-wrap; }}\n'
+            '</style></head><body style=" font-family:\'{}\'; font-size:{}pt; '
+            'font-weight:400; font-style:normal;">\n')
+    HEAD_PATTERN = re.compile(re.escape(HEAD.format('\x00', '\x01'))
+                              .replace('\x00', "([^']*)").replace('\x01', '([^;"]*)'))
+    TRAILER = '</body></html>'
+    STYLE = re.compile(r'style="([^"]*)"')
+    REF = re.compile('([\x02\x04])(\\d+)\x03')
+    # 内置样式，序号保存在已编码的正文中，只能在末尾追加
+    STYLES = (
+        ' margin-top:0px; margin-bottom:0px; margin-left:0px; margin-right:0px; '
+        '-qt-block-indent:0; text-indent:0px;',
+        '-qt-paragraph-type:empty; margin-top:0px; margin-bottom:0px; margin-left:0px; '
+        'margin-right:0px; -qt-block-indent:0; text-indent:0px;',
+        ' margin-top:12px; margin-bottom:12px; margin-left:0px; margin-right:0px; '
+        '-qt-block-indent:0; text-indent:0px;',
+        '-qt-paragraph-type:empty; margin-top:12px; margin-bottom:12px; margin-left:0px; '
+        'margin-right:0px; -qt-block-indent:0; text-indent:0px;',
+        ' font-weight:600;',
+        ' font-style:italic;',
+        ' text-decoration: underline;',
+        ' text-decoration: line-through;',
+        'margin-top: 0px; margin-bottom: 0px; margin-left: 0px; margin-right: 0px; '
+        '-qt-list-indent: 1;',
+    )
+    STYLE_INDEX = {style: i for i, style in enumerate(STYLES)}
+
+    @classmethod
+    def encode(cls, html):
+        if cls.RESERVED.search(html):
+            # 原样保存；恰好以 MARK 开头时加上标记，以免被当作已编码的内容
+            return cls.MARK + '0' + html if html.startswith(cls.MARK) else html
+        match = cls.HEAD_PATTERN.match(html)
+        if match and html.endswith(cls.TRAILER):
+            head = match.group(1) + '\x02' + match.group(2)
+            body = html[match.end():len(html) - len(cls.TRAILER)]
+        else:
+            head, body = '', html
+        counts = {}
+        for value in cls.STYLE.findall(body):
+            counts[value] = counts.get(value, 0) + 1
+        local = [value for value, count in counts.items()
+                 if count > 1 and value and value not in cls.STYLE_INDEX]
+        local_index = {value: i for i, value in enumerate(local)}
+
+        def ref(match):
+            value = match.group(1)
+            i = cls.STYLE_INDEX.get(value)
+            if i is not None:
+                return f'\x02{i}\x03'
+            i = local_index.get(value)
+            if i is not None:
+                return f'\x04{i}\x03'
+            return match.group(0)
+
+        encoded = (cls.MARK + '1' + head + '\x01' + '\x02'.join(local) + '\x01' +
+                   cls.STYLE.sub(ref, body))
+        if len(encoded) >= len(html) or cls.decode(encoded) != html:
+            return html
+        return encoded
+
+    @classmethod
+    def decode(cls, data):
+        if not data.startswith(cls.MARK):
+            return data
+        version = data[1:2]
+        if version == '0':
+            return data[2:]
+        if version != '1':
+            raise ValueError(f'unsupported content encoding {version!r}')
+        head, styles, body = data[2:].split('\x01', 2)
+        local = styles.split('\x02') if styles else []
+
+        def style(match):
+            table = cls.STYLES if match.group(1) == '\x02' else local
+            return 'style="' + table[int(match.group(2))] + '"'
+
+        body = cls.REF.sub(style, body)
+        if not head:
+            return body
+        family, size = head.split('\x02')
+        return cls.HEAD.format(family, size) + body + cls.TRAILER
+
+    @classmethod
+    def pack(cls, html):
+        # 编码后超过 CONTENT_COMPRESS_BYTES 时返回 zlib 压缩的 bytes，否则返回字符串
+        encoded = cls.encode(html)
+        if CONTENT_COMPRESS_BYTES is not None and len(encoded) >= CONTENT_COMPRESS_BYTES:
+            return zlib.compress(encoded.encode('utf-8'))
+        return encoded
+
+    @classmethod
+    def unpack(cls, value):
+        if isinstance(value, bytes):
+            value = zlib.decompress(value).decode('utf-8')
+        return cls.decode(value)
+
+def index_text(title, plain_text):
+    # 全文索引中的文本：小写的 标题\n正文
+    return (title + '\n' + plain_text).lower()
+
+def text_fingerprint(text):
+    return zlib.crc32(text.encode('utf-8'))
+
+class TextTable:
+    """便签ID -> 全文索引中的小写文本
+
+    从持久化索引恢复的文本留在 mmap 映射的文件中，只记录位置和标题、正文长度；
+    查找子串时直接在映射的 UTF-8 字节上进行（与字符串上的匹配结果相同），需要字符串时
+    才解码。本次运行中新增或修改的文本以字符串保存。
+    """
+    def __init__(self, text_map=None):
+        self.strings = {}
+        # 便签ID -> (偏移, 字节数, 标题长度, 正文长度)
+        self.pointers = {}
+        self.map = text_map
+
+    def __len__(self):
+        return len(self.strings) + len(self.pointers)
+
+    def __contains__(self, note_id):
+        return note_id in self.strings or note_id in self.pointers
+
+    def __setitem__(self, note_id, text):
+        self.pointers.pop(note_id, None)
+        self.strings[note_id] = text
+
+    def get(self, note_id, default=None):
+        text = self.strings.get(note_id)
+        if text is not None:
+            return text
+        pointer = self.pointers.get(note_id)
+        if pointer is None:
+            return default
+        offset, size = pointer[:2]
+        return self.map[offset:offset + size].decode('utf-8')
+
+    def raw(self, note_id):
+        # 文本的 UTF-8 编码，持久化的文本不经解码直接取出
+        pointer = self.pointers.get(note_id)
+        if pointer is None:
+            return self.strings[note_id].encode('utf-8')
+        offset, size = pointer[:2]
+        return self.map[offset:offset + size]
+
+    def filter(self, note_ids, query, is_cancelled=None):
+        # 返回 note_ids 中文本包含 query 的便签ID集合；is_cancelled 返回 True 时返回 None
+        strings = self.strings
+        pointers = self.pointers
+        find = self.map.find if self.map is not None else None
+        encoded = query.encode('utf-8')
+        results = set()
+        for count, note_id in enumerate(note_ids):
+            if is_cancelled is not None and count % 4096 == 0 and is_cancelled():
+                return None
+            text = strings.get(note_id)
+            if text is not None:
+                if query in text:
+                    results.add(note_id)
+                continue
+            pointer = pointers.get(note_id)
+            if pointer is not None and find(encoded, pointer[0], pointer[0] + pointer[1]) != -1:
+                results.add(note_id)
+        return results
+
+    def term_counts(self, note_id, term, encoded):
+        # 返回 (标题中的次数, 正文中的次数, 标题长度, 正文长度)，不在表中时返回 None；
+        # 持久化的文本直接在字节上计数，结果与解码后相同
+        text = self.strings.get(note_id)
+        if text is not None:
+            title, _, body = text.partition('\n')
+            return title.count(term), body.count(term), len(title), len(body)
+        pointer = self.pointers.get(note_id)
+        if pointer is None:
+            return None
+        offset, size, title_length, body_length = pointer
+        title, _, body = self.map[offset:offset + size].partition(b'\n')
+        return title.count(encoded), body.count(encoded), title_length, body_length
+
+    def lengths(self, note_id):
+        # (标题长度, 正文长度)，不在表中时返回 None
+        text = self.strings.get(note_id)
+        if text is not None:
+            title, _, body = text.partition('\n')
+            return len(title), len(body)
+        pointer = self.pointers.get(note_id)
+        return None if pointer is None else pointer[2:]
+
+    def pop(self, note_id):
+        # 移除并返回 (标题长度, 正文长度)，不在表中时返回 None
+        lengths = self.lengths(note_id)
+        self.strings.pop(note_id, None)
+        self.pointers.pop(note_id, None)
+        return lengths
+
+    def ids(self):
+        yield from self.strings
+        yield from self.pointers
+
+    def items(self):
+        for note_id in list(self.ids()):
+            yield note_id, self.get(note_id)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+class PostingTable:
+    """n-gram -> 倒排表（便签ID数组）
+
+    从持久化索引读取的倒排表留在一个连续的数组中，只记录每个 n-gram 的序号，查询时
+    复制出所需的一段，追加时才转为单独的数组。读取索引时不必创建上百万个受垃圾回收
+    跟踪的数组对象。
+    """
+    def __init__(self, saved=None, starts=None, entries=None):
+        # 本次运行中修改过的倒排表
+        self.arrays = {}
+        # n-gram -> 序号，倒排表为 entries[starts[序号]:starts[序号 + 1]]
+        self.saved = saved if saved is not None else {}
+        self.starts = starts
+        self.entries = entries
+
+    def __len__(self):
+        return len(self.arrays) + len(self.saved)
+
+    def get(self, gram, default=None):
+        posting = self.arrays.get(gram)
+        if posting is not None:
+            return posting
+        i = self.saved.get(gram)
+        if i is None:
+            return default
+        return self.entries[self.starts[i]:self.starts[i + 1]]
+
+    def append(self, gram, note_id):
+        posting = self.arrays.get(gram)
+        if posting is None:
+            posting = self.get(gram)
+            if posting is None:
+                posting = array('i')
+            else:
+                del self.saved[gram]
+            self.arrays[gram] = posting
+        posting.append(note_id)
+
+    def items(self):
+        # (n-gram, 倒排表)，持久化的倒排表以 memoryview 给出，不复制
+        yield from self.arrays.items()
+        if self.saved:
+            entries = memoryview(self.entries)
+            starts = self.starts
+            for gram, i in self.saved.items():
+                yield gram, entries[starts[i]:starts[i + 1]]
+
+class NgramIndex:
+    """字符 n-gram 倒排索引
+
+    中文没有空格分词，按单字和相邻两字建立倒排表，查询时取最短的倒排表作为候选，
+    再与其他倒排表求交并逐个校验原文。倒排表只追加不删除，修改或删除便签后留下的
+    过期条目在校验时被过滤，过期条目过多时整体重建。
+
+    按相关度排序时以空格分隔的查询词为单位用 BM25 打分，文档频率取查询词校验后的
+    命中数，标题和正文的总长度随增删便签增量维护。
+
+    持久化文件不使用 pickle，读取被改动的文件不会执行其中的代码：文件头（魔数、版本、
+    各段长度、过期条目数、文本文件标记、CRC32）之后依次是校验值、文本位置、各 n-gram
+    的字符数和倒排表起点、全部倒排表的便签ID，最后是 n-gram 拼接成的 UTF-8 文本，
+    各段都是定宽的数组，整段转换。
+    """
+    MAGIC = b'NDINDEX\n'
+    VERSION = 4
+    # 魔数, 版本, 校验值数, 文本数, n-gram 数, 倒排表条目总数, 过期条目数, 文本文件标记, CRC32
+    HEADER = struct.Struct('<8sIIIIQq16sI')
+    # 读取时每次复制的字节数，复制之间其他线程可以取得 GIL
+    READ_CHUNK = 8 * 1024 * 1024
+
+    def __init__(self):
+        # n-gram -> 包含它的便签ID数组
+        self.postings = PostingTable()
+        # 便签ID -> 索引时文本的校验值，用于判断持久化的索引是否仍然有效
+        self.fingerprints = {}
+        # 便签ID -> 小写的标题和正文，只包含已加载的便签
+        self.texts = TextTable()
+        self.stale = 0
+        # 已加载便签的标题和正文总长度，用于计算平均长度
+        self.title_length = 0
+        self.body_length = 0
+        # 持久化索引中文本的位置，启动时按校验值逐个恢复，无需读取便签正文
+        self.saved_texts = {}
+
+    @staticmethod
+    def grams(text):
+        grams = set(text)
+        grams.update(text[i:i + 2] for i in range(len(text) - 1))
+        return grams
+
+    def update_lengths(self, lengths, sign):
+        if lengths is not None:
+            self.title_length += sign * lengths[0]
+            self.body_length += sign * lengths[1]
+
+    def add(self, note_id, text):
+        text = text.lower()
+        self.update_lengths(self.texts.pop(note_id), -1)
+        self.texts[note_id] = text
+        self.update_lengths(self.texts.lengths(note_id), 1)
+        fingerprint = text_fingerprint(text)
+        old = self.fingerprints.get(note_id)
+        if old == fingerprint:
+            # 持久化的索引中已包含这段文本
+            return
+        if old is not None:
+            self.stale += 1
+        self.fingerprints[note_id] = fingerprint
+        postings = self.postings
+        for gram in self.grams(text):
+            postings.append(gram, note_id)
+
+    def restore(self, note_id, fingerprint):
+        # 持久化索引中有校验值相同的文本时直接恢复，返回是否成功
+        pointer = self.saved_texts.pop(note_id, None)
+        if pointer is None or self.fingerprints.get(note_id) != fingerprint:
+            return False
+        self.texts.pointers[note_id] = pointer
+        self.update_lengths(pointer[2:], 1)
+        return True
+
+    def remove(self, note_id):
+        self.update_lengths(self.texts.pop(note_id), -1)
+        self.saved_texts.pop(note_id, None)
+        if self.fingerprints.pop(note_id, None) is not None:
+            self.stale += 1
+
+    def search(self, query, is_cancelled=None):
+        # is_cancelled 返回 True 时中止并返回 None（查询已过期）
+        query = query.lower()
+        texts = self.texts
+        if len(query) == 1:
+            grams = [query]
+        else:
+            grams = [query[i:i + 2] for i in range(len(query) - 1)]
+        postings = []
+        for gram in set(grams):
+            posting = self.postings.get(gram)
+            if posting is None:
+                return set()
+            postings.append(posting)
+        postings.sort(key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            # 候选已经很少时直接校验比继续求交更快
+            if len(candidates) < 64:
+                break
+            candidates.intersection_update(posting)
+        return texts.filter(candidates, query, is_cancelled)
+
+    def rank(self, query, limit, is_cancelled=None, candidates=None):
+        # 对包含任一查询词的便签按 BM25F 打分，返回得分最高的 limit 个便签ID（从高到低）
+        # candidates 不为 None 时只对其中的便签打分
+        terms = set(query.lower().split())
+        texts = self.texts
+        count = len(texts)
+        if not terms or not count:
+            return []
+        avg_title = self.title_length / count or 1
+        avg_body = self.body_length / count or 1
+        scores = {}
+        for term in terms:
+            matched = self.search(term, is_cancelled)
+            if matched is None:
+                return None
+            if not matched:
+                continue
+            idf = math.log(1 + (count - len(matched) + 0.5) / (len(matched) + 0.5))
+            if candidates is not None:
+                matched &= candidates
+            encoded = term.encode('utf-8')
+            for note_id in matched:
+                counts = texts.term_counts(note_id, term, encoded)
+                if counts is None:
+                    continue
+                title_count, body_count, title_length, body_length = counts
+                tf = (TITLE_WEIGHT * title_count /
+                      (1 - BM25_B + BM25_B * title_length / avg_title) +
+                      body_count / (1 - BM25_B + BM25_B * body_length / avg_body))
+                scores[note_id] = scores.get(note_id, 0) + idf * tf / (BM25_K1 + tf)
+            if is_cancelled is not None and is_cancelled():
+                return None
+        # 只保留前 limit 个，不对全部命中排序
+        return heapq.nlargest(limit, scores, key=scores.get)
+
+    def estimate(self, query):
+        # 候选数量的上限：最短倒排表的长度，用于安排查询计划
+        query = query.lower()
+        if len(query) == 1:
+            grams = [query]
+        else:
+            grams = [query[i:i + 2] for i in range(len(query) - 1)]
+        return min(len(self.postings.get(gram, ())) for gram in grams)
+
+    def needs_rebuild(self):
+        return self.stale > max(1000, len(self.texts))
+
+    def rebuild(self):
+        texts = self.texts
+        self.postings = PostingTable()
+        self.fingerprints = {}
+        self.texts = TextTable()
+        self.saved_texts = {}
+        self.stale = 0
+        self.title_length = 0
+        self.body_length = 0
+        for note_id, text in texts.items():
+            self.add(note_id, text)
+        texts.close()
+
+    @staticmethod
+    def texts_path(path):
+        return os.path.splitext(path)[0] + '.texts'
+
+    @staticmethod
+    def map_texts(path, token):
+        # 映射文本文件，文件开头的标记与索引中记录的不一致时返回 None
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            text_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if text_map[:len(token)] != token:
+            text_map.close()
+            return None
+        return text_map
+
+    def save(self, path):
+        # 文本写入单独的文件，下次启动时映射而不读入内存；两个文件用随机标记对应
+        token = os.urandom(16)
+        texts_path = self.texts_path(path)
+        texts = self.texts
+        pointers = {}
+        with open(texts_path + '.tmp', 'wb') as f:
+            f.write(token)
+            # 尚未恢复的文本与已恢复的在同一个映射中
+            for note_id, pointer in self.saved_texts.items():
+                offset, size = pointer[:2]
+                pointers[note_id] = (f.tell(),) + tuple(pointer[1:])
+                f.write(texts.map[offset:offset + size])
+            for note_id in texts.ids():
+                data = texts.raw(note_id)
+                pointers[note_id] = (f.tell(), len(data)) + tuple(texts.lengths(note_id))
+                f.write(data)
+        text_values = array('q')
+        for pointer in pointers.values():
+            text_values.extend(pointer)
+        grams = []
+        gram_lengths = array('B')
+        posting_starts = array('q', (0,))
+        entry_count = 0
+        for gram, posting in self.postings.items():
+            grams.append(gram)
+            gram_lengths.append(len(gram))
+            entry_count += len(posting)
+            posting_starts.append(entry_count)
+        sections = [
+            array('i', self.fingerprints), array('I', self.fingerprints.values()),
+            array('i', pointers), text_values, gram_lengths, posting_starts,
+        ]
+        grams = ''.join(grams).encode('utf-8')
+        temp_file = path + '.tmp'
+        with open(temp_file, 'wb') as f:
+            # 先占位写入文件头，写完各段后补上 CRC32
+            f.write(bytes(self.HEADER.size))
+            checksum = 0
+            for section in sections:
+                checksum = zlib.crc32(section, checksum)
+                f.write(section)
+            for _, posting in self.postings.items():
+                checksum = zlib.crc32(posting, checksum)
+                f.write(posting)
+            checksum = zlib.crc32(grams, checksum)
+            f.write(grams)
+            f.seek(0)
+            f.write(self.HEADER.pack(self.MAGIC, self.VERSION, len(self.fingerprints), len(pointers),
+                                     len(gram_lengths), entry_count, self.stale, token, checksum))
+        # 替换前关闭旧文件的映射，然后映射新文件，保存后索引仍可继续使用
+        texts.close()
+        os.replace(texts_path + '.tmp', texts_path)
+        os.replace(temp_file, path)
+        table = TextTable(self.map_texts(texts_path, token))
+        for note_id in texts.ids():
+            table.pointers[note_id] = pointers[note_id]
+        self.texts = table
+        self.saved_texts = {note_id: pointer for note_id, pointer in pointers.items()
+                            if note_id not in table}
+
+    def load(self, path):
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            if len(data) < self.HEADER.size:
+                raise ValueError('truncated header')
+            (magic, version, fingerprint_count, text_count, gram_count, entry_count, stale,
+             token, checksum) = self.HEADER.unpack_from(data, 0)
+            if magic != self.MAGIC or version != self.VERSION:
+                raise ValueError('not a search index or unsupported version')
+            body = memoryview(data)[self.HEADER.size:]
+            if zlib.crc32(body) != checksum:
+                raise ValueError('checksum mismatch')
+            offset = 0
+
+            def section(typecode, count):
+                nonlocal offset
+                values = array(typecode)
+                size = values.itemsize * count
+                if offset + size > len(body):
+                    raise ValueError('section out of range')
+                end = offset + size
+                for start in range(offset, end, self.READ_CHUNK):
+                    values.frombytes(body[start:min(start + self.READ_CHUNK, end)])
+                offset = end
+                return values
+
+            fingerprint_ids = section('i', fingerprint_count)
+            fingerprints = dict(zip(fingerprint_ids, section('I', fingerprint_count)))
+            text_ids = section('i', text_count)
+            text_values = section('q', 4 * text_count)
+            saved_texts = {note_id: tuple(text_values[i:i + 4])
+                           for note_id, i in zip(text_ids, range(0, 4 * text_count, 4))}
+            gram_lengths = section('B', gram_count)
+            starts = section('q', gram_count + 1)
+            if starts[0] != 0 or starts[-1] != entry_count:
+                raise ValueError('posting count mismatch')
+            entries = section('i', entry_count)
+            text = body[offset:].tobytes().decode('utf-8')
+            if sum(gram_lengths) != len(text):
+                raise ValueError('gram text length mismatch')
+            saved = {}
+            gram_at = 0
+            for i, gram_length in enumerate(gram_lengths):
+                saved[text[gram_at:gram_at + gram_length]] = i
+                gram_at += gram_length
+            self.postings = PostingTable(saved, starts, entries)
+            self.fingerprints = fingerprints
+            self.stale = stale
+            text_map = self.map_texts(self.texts_path(path), token)
+            if text_map is not None:
+                self.texts = TextTable(text_map)
+                self.saved_texts = saved_texts
+        except Exception as e:
+            print(f"Error loading search index: {e}")
+
+class NoteStorage:
+    """便签存储后端接口
+
+    变更以记录的形式批量写入：
+    {'op': 'add', 'note': {...}}、{'op': 'set', 'id': ..., 'fields': {...}}、
+    {'op': 'order', 'ids': [...]}
+    write 和 compact 在后台写入线程中调用，失败时抛出异常。
+    load_pages 返回的便签不含正文字段（BODY_FIELDS），正文由 load_body 按需读取；
+    写入的记录和快照中可以带正文，也可以不带（快照中不带正文的便签保留已保存的正文）。
+    """
+    def load(self):
+        raise NotImplementedError
+
+    def load_pages(self, page_size):
+        # 分页读取便签的元数据，尽量按显示顺序；不支持分页的后端一次返回全部。
+        # 分页时便签带有 'position'，全部加载后按它恢复存储顺序（拖动排序）
+        raise NotImplementedError
+
+    def load_body(self, note_id):
+        # 返回便签的正文字段，可能在后台线程中调用
+        raise NotImplementedError
+
+    def max_id(self):
+        return -1
+
+    def export_json(self, path):
+        # 把包含正文的全部便签导出为便于阅读的 JSON，用于调试
+        notes = self.load()
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(notes, f, ensure_ascii=False, indent=2)
+        return len(notes)
+
+    def write(self, records):
+        raise NotImplementedError
+
+    def discard(self, records):
+        # 尚未写入的记录被快照取代时，在合并这个快照之前调用
+        pass
+
+    def needs_compaction(self):
+        return False
+
+    def compact(self, notes):
+        return True
+
+    def close(self):
+        pass
+
+class NoteSnapshot:
+    """便签元数据的二进制快照文件（JSON 后端的每个分片，以及旧版本的 notes.snap）
+
+    文件头（魔数、格式版本、便签数量、段数、CRC32）之后是段表和各段：每个字段一段定宽的列，
+    每个便签一行，行按显示顺序排列（先置顶，再未置顶，最后是已删除的便签），分页加载时
+    每页是连续的行，各列整段转换；storage 段是按存储顺序排列的行号，position 段是各行在
+    全部便签（可能跨多个分片）的存储顺序中的位置，较早的文件没有这一段。字符串字段的列保存
+    (偏移, 长度)，内容在末尾的字符串堆中，相同的字符串只保存一次。
+    通过 mmap 打开，各列直接作为 memoryview 访问，便签只在所在的页被读取时才解码。
+    CRC32 覆盖文件头之后的全部内容。正文不在快照中，body_* 列指向正文文件中的段。
+    """
+    MAGIC = b'NDSNAP\r\n'
+    VERSION = 1
+    HEADER = struct.Struct('<8sIIII')  # 魔数, 版本, 便签数量, 段数, CRC32
+    SECTION = struct.Struct('<24sQQ')  # 段名, 偏移, 字节数
+    # 标志位；没有 text_crc 或正文时对应的列无意义
+    PINNED = 1
+    DELETED = 2
+    HAS_CRC = 4
+    HAS_BODY = 8
+    # 定宽列：(段名, array 类型)
+    NUMBER_COLUMNS = (('ids', 'q'), ('flags', 'B'), ('create_time', 'd'), ('pin_time', 'd'),
+                      ('delete_time', 'd'), ('text_crc', 'I'), ('body_generation', 'I'),
+                      ('body_offset', 'Q'), ('body_length', 'I'), ('storage', 'I'),
+                      ('position', 'q'))
+    # 较早的文件中可能没有的段
+    OPTIONAL_COLUMNS = frozenset(('position',))
+    TIMES = ('create_time', 'pin_time', 'delete_time')
+    # 字符串字段，images 以换行分隔，extra 为其余字段的 JSON
+    TEXTS = ('title', 'timestamp', 'background_color', 'preview')
+    STRINGS = TEXTS + ('images', 'extra')
+    KNOWN_FIELDS = frozenset(('id', 'is_pinned', 'is_deleted', 'text_crc', 'body', 'images') +
+                             TIMES + TEXTS)
+    # 字符串长度为该值表示没有这个字段
+    ABSENT = 0xFFFFFFFF
+    # 不超过该长度的字符串（时间戳、颜色等）大多重复，解码一次并共用
+    SHARED_LENGTH = 16
+
+    class Error(Exception):
+        """快照损坏或格式版本不支持"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.views = {}
+        # 堆中的偏移 -> 已解码的短字符串（非空字符串的偏移各不相同）
+        self.shared = {}
+        try:
+            self.parse()
+        except Exception:
+            self.close()
+            raise
+
+    @classmethod
+    def typecodes(cls):
+        # 段名 -> array 类型（不含字符串堆）
+        typecodes = dict(cls.NUMBER_COLUMNS)
+        for name in cls.STRINGS:
+            typecodes[name + '_at'] = 'I'
+            typecodes[name + '_len'] = 'I'
+        return typecodes
+
+    def parse(self):
+        if len(self.map) < self.HEADER.size:
+            raise self.Error('truncated header')
+        magic, version, count, sections, checksum = self.HEADER.unpack_from(self.map, 0)
+        if magic != self.MAGIC:
+            raise self.Error('not a note snapshot')
+        if version != self.VERSION:
+            # 目前只有第 1 版；以后的版本在这里按版本逐级转换
+            raise self.Error(f'unsupported snapshot version {version}')
+        whole = memoryview(self.map)
+        self.views['file'] = whole
+        if zlib.crc32(whole[self.HEADER.size:]) != checksum:
+            raise self.Error('checksum mismatch')
+        self.count = count
+        table = {}
+        for i in range(sections):
+            name, offset, size = self.SECTION.unpack_from(
+                self.map, self.HEADER.size + i * self.SECTION.size)
+            if offset + size > len(self.map):
+                raise self.Error('section out of range')
+            table[name.rstrip(b'\0').decode('ascii')] = whole[offset:offset + size]
+        try:
+            for name, typecode in self.typecodes().items():
+                if name in table or name not in self.OPTIONAL_COLUMNS:
+                    self.views[name] = table[name].cast(typecode)
+            self.heap = self.views['heap'] = table.pop('heap')
+        except KeyError as e:
+            raise self.Error(f'missing section {e}') from None
+        finally:
+            for view in table.values():
+                view.release()
+
+    def __len__(self):
+        return self.count
+
+    def column(self, name):
+        return self.views[name]
+
+    def positions(self, start, end, base=0):
+        # 第 [start, end) 行的存储位置；没有 position 段时为 base 加分片内的存储顺序
+        view = self.views.get('position')
+        if view is not None:
+            return view[start:end].tolist()
+        ranks = [0] * self.count
+        for rank, row in enumerate(self.views['storage'].tolist()):
+            ranks[row] = base + rank
+        return ranks[start:end]
+
+    def strings(self, name, start, end):
+        # 第 [start, end) 行的字符串字段，没有该字段的行为 None
+        heap, shared, absent = self.heap, self.shared, self.ABSENT
+        values = []
+        for offset, size in zip(self.views[name + '_at'][start:end].tolist(),
+                                self.views[name + '_len'][start:end].tolist()):
+            if size == absent:
+                value = None
+            elif size == 0:
+                # 空字符串不占用堆空间，偏移可能与下一个字符串相同，不能按偏移共用
+                value = ''
+            elif size <= self.SHARED_LENGTH:
+                value = shared.get(offset)
+                if value is None:
+                    value = shared[offset] = str(heap[offset:offset + size], 'utf-8')
+            else:
+                value = str(heap[offset:offset + size], 'utf-8')
+            values.append(value)
+        return values
+
+    def notes(self, start, end):
+        # 把第 [start, end) 行解码为元数据 dict 的列表，正文指针在 'body' 中
+        views = self.views
+        flags = views['flags'][start:end].tolist()
+        notes = [{'id': note_id, 'is_pinned': bool(bits & self.PINNED),
+                  'is_deleted': bool(bits & self.DELETED)}
+                 for note_id, bits in zip(views['ids'][start:end].tolist(), flags)]
+        for name in self.TIMES:
+            for note, value in zip(notes, views[name][start:end].tolist()):
+                # NaN 表示没有这个字段
+                if value == value:
+                    note[name] = value
+        for name in self.TEXTS:
+            for note, value in zip(notes, self.strings(name, start, end)):
+                if value is not None:
+                    note[name] = value
+        for note, value in zip(notes, self.strings('images', start, end)):
+            if value is not None:
+                note['images'] = value.split('\n') if value else []
+        for note, bits, value in zip(notes, flags, views['text_crc'][start:end].tolist()):
+            if bits & self.HAS_CRC:
+                note['text_crc'] = value
+        pointers = zip(flags, views['body_generation'][start:end].tolist(),
+                       views['body_offset'][start:end].tolist(),
+                       views['body_length'][start:end].tolist())
+        for note, (bits, generation, offset, length) in zip(notes, pointers):
+            if bits & self.HAS_BODY:
+                note['body'] = [generation, offset, length]
+        for note, value in zip(notes, self.strings('extra', start, end)):
+            if value is not None:
+                note.update(json.loads(value))
+        return notes
+
+    def close(self):
+        # memoryview 全部释放后才能关闭 mmap
+        for view in reversed(list(self.views.values())):
+            view.release()
+        self.views = {}
+        self.map.close()
+
+    @staticmethod
+    def display_order(notes):
+        # 与 SQLite 后端分页的顺序相同：先置顶，再未置顶，最后是已删除的便签
+        def key(i):
+            note = notes[i]
+            if note.get('is_deleted', False):
+                return 2, 0, note['id']
+            if note.get('is_pinned', False):
+                return 0, -(note.get('pin_time') or 0), note['id']
+            return 1, -(note.get('create_time') or 0), note['id']
+        return sorted(range(len(notes)), key=key)
+
+    @classmethod
+    def write(cls, path, notes, positions=None):
+        # notes 为按存储顺序排列的元数据 dict（正文指针在 'body' 中），positions 为它们在
+        # 全部便签中的存储位置（默认为在 notes 中的序号）；写入临时文件后替换，返回文件大小
+        columns = {name: array(typecode) for name, typecode in cls.typecodes().items()}
+        heap = bytearray()
+        # 字符串 -> 在堆中的 (偏移, 长度)
+        interned = {}
+
+        def add_string(name, value):
+            if value is None:
+                ref = (0, cls.ABSENT)
+            else:
+                ref = interned.get(value)
+                if ref is None:
+                    data = value.encode('utf-8')
+                    ref = interned[value] = (len(heap), len(data))
+                    heap.extend(data)
+            columns[name + '_at'].append(ref[0])
+            columns[name + '_len'].append(ref[1])
+
+        display = cls.display_order(notes)
+        storage = [0] * len(notes)
+        for row, i in enumerate(display):
+            storage[i] = row
+        columns['storage'].extend(storage)
+        if positions is None:
+            positions = range(len(notes))
+        columns['position'].extend([positions[i] for i in display])
+        for i in display:
+            note = notes[i]
+            flags = 0
+            if note.get('is_pinned', False):
+                flags |= cls.PINNED
+            if note.get('is_deleted', False):
+                flags |= cls.DELETED
+            text_crc = note.get('text_crc')
+            if text_crc is not None:
+                flags |= cls.HAS_CRC
+            body = note.get('body')
+            if body is not None:
+                flags |= cls.HAS_BODY
+            columns['ids'].append(note['id'])
+            columns['flags'].append(flags)
+            for name in cls.TIMES:
+                value = note.get(name)
+                columns[name].append(math.nan if value is None else value)
+            columns['text_crc'].append(text_crc or 0)
+            generation, offset, length = body or (0, 0, 0)
+            columns['body_generation'].append(generation)
+            columns['body_offset'].append(offset)
+            columns['body_length'].append(length)
+            extra = {key: value for key, value in note.items() if key not in cls.KNOWN_FIELDS}
+            for name in cls.TEXTS:
+                value = note.get(name)
+                if value is not None and not isinstance(value, str):
+                    # 不是字符串的值（旧数据）原样保存在 extra 中
+                    extra[name] = value
+                    value = None
+                add_string(name, value)
+            images = note.get('images')
+            add_string('images', None if images is None else '\n'.join(images))
+            add_string('extra', json.dumps(extra, ensure_ascii=False) if extra else None)
+
+        sections = [(name, column.tobytes()) for name, column in columns.items()]
+        sections.append(('heap', bytes(heap)))
+        # 各段按 8 字节对齐，便于按类型转换 memoryview
+        body = bytearray(cls.SECTION.size * len(sections))
+        offset = cls.HEADER.size + len(body)
+        for i, (name, data) in enumerate(sections):
+            padding = -offset % 8
+            body.extend(bytes(padding))
+            offset += padding
+            cls.SECTION.pack_into(body, i * cls.SECTION.size, name.encode('ascii'), offset, len(data))
+            body.extend(data)
+            offset += len(data)
+        header = cls.HEADER.pack(cls.MAGIC, cls.VERSION, len(notes), len(sections), zlib.crc32(body))
+        temp_file = path + '.tmp'
+        with open(temp_file, 'wb') as f:
+            f.write(header)
+            f.write(body)
+        os.replace(temp_file, path)
+        return len(header) + len(body)
+
+class JsonNoteStorage(NoteStorage):
+    """按ID分片的二进制快照加追加写的 JSON 变更日志
+
+    快照按便签ID每 SHARD_NOTES 个分为一片，保存为 shards/notes.<片号>.snap，每个分片是
+    独立的 NoteSnapshot 文件，有自己的校验和，损坏时只丢失该分片。合并时只重写日志中
+    有变更的分片。分页加载时各分片的行按显示顺序归并，置顶的便签总在最前面的几页；
+    存储顺序（拖动排序）保存在各行的 position 段中，是在全部便签中的位置。
+    快照和日志只保存元数据，正文追加写入分段的 bodies.<代>.dat，元数据中的
+    'body': [代, 偏移, 长度] 指向正文所在的段，读取时通过 mmap 按需取出。
+    合并快照时若失效的段超过一半，把仍在使用的段复制到下一代文件。
+    旧版本的 notes.json 或 notes.snap 单文件快照照常读取，第一次合并时转换为分片。
+    """
+    BODY_FILE = re.compile(r'^bodies\.(\d+)\.dat$')
+    SHARD_FILE = re.compile(r'^notes\.(\d+)\.snap$')
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.shards_dir = os.path.join(data_dir, 'shards')
+        # 分片号 -> 磁盘上该分片的便签数量，合并时数量变化（永久删除）的分片也要重写
+        self.shard_counts = {}
+        # 分片号 -> 分片文件的大小，判断是否需要合并时不必逐个读取文件信息
+        self.shard_sizes = {}
+        # 日志中有变更、下次合并时需要重写的分片号；在后台写入线程中更新，读写时持有 shard_lock
+        self.dirty_shards = set()
+        self.shard_lock = threading.Lock()
+        # 旧版本的单文件快照，存在时下次合并转换为分片
+        self.snapshot_file = os.path.join(data_dir, 'notes.snap')
+        self.data_file = os.path.join(data_dir, 'notes.json')
+        self.legacy = os.path.exists(self.snapshot_file) or os.path.exists(self.data_file)
+        # 追加写的变更日志，每行一条单个便签的变更记录
+        self.journal_file = os.path.join(data_dir, 'notes.journal')
+        self.journal_size = 0
+        self.journal_corrupt = False
+        # 便签ID -> (代, 偏移, 长度)
+        self.body_index = {}
+        # 旧版本直接保存在快照和日志中的正文，下次合并时移到正文文件
+        self.inline_bodies = {}
+        # 快照和日志中最大的便签ID，分页加载时尚未加载的便签也计入
+        self.max_note_id = -1
+        # 新的正文追加到当前代的文件
+        self.generation = max(self.body_generations(), default=0)
+        # 代 -> 正文文件的 mmap
+        self.body_maps = {}
+        # 正文在界面线程中读取、在后台写入线程中写入
+        self.body_lock = threading.Lock()
+
+    def body_path(self, generation):
+        return os.path.join(self.data_dir, f'bodies.{generation}.dat')
+
+    def body_generations(self):
+        generations = []
+        if os.path.isdir(self.data_dir):
+            for name in os.listdir(self.data_dir):
+                match = self.BODY_FILE.match(name)
+                if match:
+                    generations.append(int(match.group(1)))
+        return generations
+
+    def load(self):
+        # 读取包含正文的全部便签，用于迁移到其他后端
+        notes = []
+        for page in self.load_pages(0):
+            notes.extend(page)
+        for note in notes:
+            note.update(self.load_body(note['id']))
+        return notes
+
+    def shard_key(self, note_id):
+        return note_id // SHARD_NOTES
+
+    def shard_path(self, key):
+        return os.path.join(self.shards_dir, f'notes.{key}.snap')
+
+    def shard_keys(self):
+        keys = []
+        if os.path.isdir(self.shards_dir):
+            for name in os.listdir(self.shards_dir):
+                match = self.SHARD_FILE.match(name)
+                if match:
+                    keys.append(int(match.group(1)))
+        return keys
+
+    def mark_dirty(self, record):
+        op = record.get('op')
+        if op == 'add':
+            ids = [record['note']['id']]
+        elif op == 'set':
+            ids = [record['id']]
+        elif op == 'order':
+            ids = record['ids']
+        else:
+            ids = []
+        keys = {self.shard_key(note_id) for note_id in ids}
+        with self.shard_lock:
+            self.dirty_shards |= keys
+
+    def load_pages(self, page_size):
+        # 全部分片按显示顺序分页读取，page_size 为 0 时按存储顺序一次返回全部；
+        # 日志中的变更在便签所在的页返回前应用，正文由 load_body 按需读取。
+        # 旧版本的单文件快照还在时（尚未完成迁移）以它为准
+        records = self.read_journal()
+        for record in records:
+            self.mark_dirty(record)
+        snapshot = self.open_snapshot(self.snapshot_file)
+        if snapshot is not None:
+            yield from self.load_snapshots([(self.snapshot_file, snapshot)], records, page_size)
+        elif os.path.exists(self.data_file):
+            notes = self.load_legacy()
+            for note in notes:
+                self.take_body(note['id'], note)
+            by_id = {note['id']: note for note in notes}
+            for record in records:
+                self.apply_record(notes, by_id, record)
+            yield notes
+        else:
+            snapshots = []
+            bases = []
+            for key in sorted(self.shard_keys(), reverse=True):
+                path = self.shard_path(key)
+                shard = self.open_snapshot(path)
+                if shard is not None:
+                    snapshots.append((path, shard))
+                    # 较早的分片没有 position 段，跨分片按ID排列
+                    bases.append(key * SHARD_NOTES)
+                    self.shard_counts[key] = len(shard)
+                    self.shard_sizes[key] = len(shard.map)
+            yield from self.load_snapshots(snapshots, records, page_size, bases)
+
+    def load_snapshots(self, snapshots, records, page_size, bases=None):
+        # snapshots 为按ID从新到旧排列的 [(路径, NoteSnapshot)]，读取完毕后关闭；
+        # bases 为各快照没有 position 段时存储位置的起点
+        try:
+            known = set()
+            for _, snapshot in snapshots:
+                known.update(snapshot.column('ids').tolist())
+            self.max_note_id = max(known, default=-1)
+            # 快照中的便签ID -> 日志中对它的修改；日志中新建的便签
+            changes = {}
+            added = []
+            added_by_id = {}
+            order = None
+            for record in records:
+                op = record.get('op')
+                note_id = record['note']['id'] if op == 'add' else record.get('id')
+                if op == 'order':
+                    order = record
+                elif note_id in known:
+                    changes.setdefault(note_id, []).append(
+                        record['note'] if op == 'add' else record['fields'])
+                else:
+                    self.apply_record(added, added_by_id, record)
+            # 尚未加载的便签也要计入，新便签的ID不能与它们重复
+            self.max_note_id = max([self.max_note_id] + list(added_by_id))
+            # 与 apply_record 相同：排序记录中列出的便签按记录的顺序，其余的排在后面并保持原有顺序
+            ordered = {} if order is None else {
+                note_id: i for i, note_id in enumerate(order['ids'])}
+            positions = [snapshot.positions(0, len(snapshot), bases[i] if bases else 0)
+                         for i, (_, snapshot) in enumerate(snapshots)]
+            # 日志中新建的便签排在快照中的全部便签之后
+            count = 1 + max((max(p, default=-1) for p in positions), default=-1)
+            for i, note in enumerate(added):
+                note['position'] = ordered.get(note['id'], len(ordered) + count + i)
+
+            def apply_changes(notes, positions):
+                for note, position in zip(notes, positions):
+                    self.take_body(note['id'], note)
+                    for fields in changes.get(note['id'], ()):
+                        self.take_body(note['id'], fields)
+                        note.update(fields)
+                    note['position'] = ordered.get(note['id'], len(ordered) + position)
+                return notes
+
+            if page_size <= 0:
+                notes = list(added)
+                for i, (_, snapshot) in enumerate(snapshots):
+                    notes += apply_changes(snapshot.notes(0, len(snapshot)), positions[i])
+                notes.sort(key=lambda note: note.pop('position'))
+                yield notes
+                return
+            # 日志中新建的便签最新，最先返回；快照中的便签跨分片按显示顺序分页。
+            # 每个便签带有 'position'，调用方全部加载后据此恢复存储顺序（拖动排序）
+            if added:
+                yield added
+            def read_page(runs):
+                notes = []
+                for index, start, end in runs:
+                    notes += apply_changes(snapshots[index][1].notes(start, end),
+                                           positions[index][start:end])
+                return notes
+
+            runs = []
+            size = 0
+            for index, start, end in self.display_runs([snapshot for _, snapshot in snapshots]):
+                while start < end:
+                    stop = min(end, start + page_size - size)
+                    runs.append((index, start, stop))
+                    size += stop - start
+                    start = stop
+                    if size == page_size:
+                        yield read_page(runs)
+                        runs = []
+                        size = 0
+            if runs:
+                yield read_page(runs)
+        finally:
+            for _, snapshot in snapshots:
+                snapshot.close()
+
+    @staticmethod
+    def display_runs(snapshots):
+        # 按显示顺序逐段返回各快照中连续的行 (快照序号, 起始行, 结束行)。快照内的行已按
+        # 置顶的、未置顶的、已删除的便签排列，各类别分别在快照之间归并，置顶的便签无论在
+        # 哪个分片都先返回；每次用二分查找取出一个快照中排在其他快照之前的整段行
+        categories = ([], [], [])
+        for index, snapshot in enumerate(snapshots):
+            flags = snapshot.column('flags')
+            ids = snapshot.column('ids')
+            rows = range(len(snapshot))
+
+            def category(row, flags=flags):
+                if flags[row] & NoteSnapshot.DELETED:
+                    return 2
+                return 0 if flags[row] & NoteSnapshot.PINNED else 1
+
+            def time_key(times, ids=ids):
+                # NaN（没有时间）与 SQLite 后端的 NULL 一样按 0 排序
+                return lambda row: (-times[row] if times[row] == times[row] else 0, ids[row])
+
+            pinned_end = bisect.bisect_left(rows, 1, key=category)
+            deleted_start = bisect.bisect_left(rows, 2, pinned_end, key=category)
+            bounds = (0, pinned_end, deleted_start, len(snapshot))
+            keys = (time_key(snapshot.column('pin_time')),
+                    time_key(snapshot.column('create_time')),
+                    lambda row, ids=ids: ids[row])
+            for i, key in enumerate(keys):
+                if bounds[i] < bounds[i + 1]:
+                    categories[i].append((key(bounds[i]), index, bounds[i], bounds[i + 1], key))
+        for heap in categories:
+            heapq.heapify(heap)
+            while heap:
+                _, index, start, end, key = heapq.heappop(heap)
+                stop = end
+                if heap:
+                    # 各快照的ID互不相同，键不会相等
+                    stop = bisect.bisect_left(range(end), heap[0][0], start + 1, end, key=key)
+                yield index, start, stop
+                if stop < end:
+                    heapq.heappush(heap, (key(stop), index, stop, end, key))
+
+    def max_id(self):
+        return self.max_note_id
+
+    def open_snapshot(self, path):
+        # 没有快照时返回 None；快照损坏或版本不支持时改名保留，同样返回 None
+        if not os.path.exists(path):
+            return None
+        try:
+            return NoteSnapshot(path)
+        except Exception as e:
+            print(f"Error loading note snapshot {path}: {e}")
+            try:
+                os.replace(path, path + '.bad')
+            except OSError as e:
+                print(f"Error moving {path}: {e}")
+            return None
+
+    def load_legacy(self):
+        # 旧版本的 notes.json，下次合并时转换为分片
+        try:
+            with open(self.data_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"Error loading notes: {e}")
+            return []
+
+    def take_body(self, note_id, fields):
+        # 从元数据中取出正文指针，以及旧版本直接保存的正文
+        pointer = fields.pop('body', None)
+        if pointer is not None:
+            self.body_index[note_id] = tuple(pointer)
+            self.inline_bodies.pop(note_id, None)
+        for name in BODY_FIELDS:
+            if name in fields:
+                self.inline_bodies.setdefault(note_id, {})[name] = fields.pop(name)
+
+    def load_body(self, note_id):
+        with self.body_lock:
+            return self.read_body(note_id)
+
+    def read_body(self, note_id):
+        # 调用时需持有 body_lock
+        body = {}
+        pointer = self.body_index.get(note_id)
+        if pointer is not None:
+            try:
+                body = self.decode_body(self.read_segment(pointer))
+            except Exception as e:
+                print(f"Error loading note body {note_id}: {e}")
+        inline = self.inline_bodies.get(note_id)
+        if inline:
+            body.update(inline)
+        return body
+
+    def read_segment(self, pointer):
+        generation, offset, length = pointer
+        body_map = self.body_maps.get(generation)
+        if body_map is None or offset + length > len(body_map):
+            # 文件在映射之后追加过，重新映射
+            if body_map is not None:
+                body_map.close()
+            with open(self.body_path(generation), 'rb') as f:
+                body_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.body_maps[generation] = body_map
+        return body_map[offset:offset + length]
+
+    @staticmethod
+    def encode_body(body):
+        # 正文段为 JSON，其中的 content 经 ContentCodec 编码；超过 CONTENT_COMPRESS_BYTES
+        # 时整段以 zlib 压缩（JSON 以 '{' 开头，zlib 数据不会）
+        content = body.get('content')
+        if isinstance(content, str):
+            body = dict(body, content=ContentCodec.encode(content))
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        if CONTENT_COMPRESS_BYTES is not None and len(data) >= CONTENT_COMPRESS_BYTES:
+            data = zlib.compress(data)
+        return data
+
+    @staticmethod
+    def decode_body(data):
+        if data[:1] != b'{':
+            data = zlib.decompress(data)
+        body = json.loads(data)
+        content = body.get('content')
+        if isinstance(content, str):
+            body['content'] = ContentCodec.decode(content)
+        return body
+
+    def append_body(self, note_id, body, body_file):
+        data = self.encode_body(body)
+        offset = body_file.tell()
+        body_file.write(data)
+        self.body_index[note_id] = (self.generation, offset, len(data))
+        return [self.generation, offset, len(data)]
+
+    def store_body(self, record, body_file):
+        # 把记录中的正文写入正文文件，返回只含元数据和正文指针的记录
+        op = record.get('op')
+        if op == 'add':
+            meta, body = split_body(record['note'])
+            if body:
+                meta['body'] = self.append_body(meta['id'], body, body_file)
+            return {'op': 'add', 'note': meta}
+        if op == 'set':
+            meta, body = split_body(record['fields'])
+            if body:
+                if len(body) < len(BODY_FIELDS):
+                    # 只修改了部分正文字段，与已保存的正文合并（可能就在本批中刚写入）
+                    body_file.flush()
+                    body = dict(self.read_body(record['id']), **body)
+                meta['body'] = self.append_body(record['id'], body, body_file)
+            return {'op': 'set', 'id': record['id'], 'fields': meta}
+        return record
+
+    def read_journal(self):
+        # 返回变更日志中的全部记录
+        records = []
+        if not os.path.exists(self.journal_file):
+            self.journal_size = 0
+            return records
+        try:
+            with open(self.journal_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # 程序崩溃时最后一条记录可能只写了一半，直接跳过
+                        print(f"Skipping corrupt journal record: {line[:80]}")
+                        self.journal_corrupt = True
+                        continue
+                    records.append(record)
+            self.journal_size = os.path.getsize(self.journal_file)
+        except Exception as e:
+            print(f"Error replaying journal: {e}")
+        return records
+
+    def apply_record(self, notes, by_id, record):
+        # 记录重放是幂等的：合并快照后若日志未及时清空，再次重放结果不变
+        op = record.get('op')
+        if op == 'add':
+            note = record['note']
+            self.take_body(note['id'], note)
+            if note['id'] in by_id:
+                by_id[note['id']].update(note)
+            else:
+                notes.append(note)
+                by_id[note['id']] = note
+        elif op == 'set':
+            note = by_id.get(record['id'])
+            if note is not None:
+                self.take_body(record['id'], record['fields'])
+                note.update(record['fields'])
+        elif op == 'order':
+            ids = record['ids']
+            listed = set(ids)
+            ordered = [by_id[note_id] for note_id in ids if note_id in by_id]
+            notes[:] = ordered + [note for note in notes if note['id'] not in listed]
+
+    def write(self, records):
+        # 正文先于引用它的日志记录写入
+        with self.body_lock, open(self.body_path(self.generation), 'ab') as body_file:
+            records = [self.store_body(record, body_file) for record in records]
+        data = ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+        with open(self.journal_file, 'a', encoding='utf-8') as f:
+            f.write(data)
+        self.journal_size += len(data.encode('utf-8'))
+        for record in records:
+            self.mark_dirty(record)
+
+    def discard(self, records):
+        # 记录不会写入日志，它们所在的分片仍需在合并快照时重写
+        for record in records:
+            self.mark_dirty(record)
+
+    def needs_compaction(self):
+        # 日志中有残缺记录时立即合并，避免后续记录接在残缺行之后
+        if self.journal_corrupt:
+            return True
+        # 旧版本的正文还在快照中，合并后才能按需读取
+        if self.inline_bodies:
+            return True
+        # 还是旧版本的单文件快照时转换为分片
+        if self.legacy:
+            return True
+        # 日志比需要重写的分片还大时才合并，使每次写入的均摊成本与变更大小成正比；
+        # 在界面线程中调用，复制脏分片集合后按内存中记录的大小计算，不读取文件信息
+        if self.journal_size < JOURNAL_COMPACT_BYTES:
+            return False
+        with self.shard_lock:
+            dirty = list(self.dirty_shards)
+        return self.journal_size >= sum(self.shard_sizes.get(key, 0) for key in dirty)
+
+    def compact(self, notes):
+        # 重写有变更的分片（每个分片写入临时文件后重命名，保证原子性）并清空变更日志；
+        # 快照中带正文的便签（尚未写入的修改）先写入正文文件
+        with self.body_lock:
+            snapshot = []
+            with self.shard_lock:
+                dirty = set(self.dirty_shards)
+            with open(self.body_path(self.generation), 'ab') as body_file:
+                for note in notes:
+                    meta, body = split_body(note)
+                    note_id = meta['id']
+                    if not body and note_id in self.inline_bodies:
+                        body = self.read_body(note_id)
+                    if body:
+                        self.append_body(note_id, body, body_file)
+                        dirty.add(self.shard_key(note_id))
+                    snapshot.append(meta)
+            self.inline_bodies = {}
+            self.body_index = {meta['id']: self.body_index[meta['id']]
+                               for meta in snapshot if meta['id'] in self.body_index}
+            rewrite_all = self.needs_body_rewrite()
+            if rewrite_all:
+                # 全部正文指针都已改变
+                self.rewrite_bodies()
+            # 分片号 -> (元数据, 在全部便签中的存储位置)
+            shards = {}
+            for position, meta in enumerate(snapshot):
+                pointer = self.body_index.get(meta['id'])
+                if pointer is not None:
+                    meta['body'] = list(pointer)
+                metas, positions = shards.setdefault(self.shard_key(meta['id']), ([], []))
+                metas.append(meta)
+                positions.append(position)
+            removed = set(self.shard_keys()) - set(shards)
+            # 有便签被永久删除时其后的存储位置都会改变，全部重写
+            if removed or any(len(metas) < self.shard_counts.get(key, 0)
+                              for key, (metas, _) in shards.items()):
+                rewrite_all = True
+            os.makedirs(self.shards_dir, exist_ok=True)
+            for key, (metas, positions) in shards.items():
+                if rewrite_all or key in dirty or self.shard_counts.get(key) != len(metas):
+                    self.shard_sizes[key] = NoteSnapshot.write(
+                        self.shard_path(key), metas, positions)
+            for key in removed:
+                # 分片中的便签已全部永久删除
+                self.shard_sizes.pop(key, None)
+                try:
+                    os.remove(self.shard_path(key))
+                except OSError as e:
+                    print(f"Error removing {self.shard_path(key)}: {e}")
+            self.shard_counts = {key: len(metas) for key, (metas, _) in shards.items()}
+            with self.shard_lock:
+                self.dirty_shards = set()
+            if self.legacy:
+                for path in (self.snapshot_file, self.data_file):
+                    if os.path.exists(path):
+                        # 旧版本的快照已转换，保留作为备份；在截断日志之前改名，
+                        # 中途退出时下次启动从分片加完整的日志读取
+                        os.replace(path, path + '.migrated')
+                self.legacy = False
+            # 分片已包含全部变更，截断日志
+            open(self.journal_file, 'w', encoding='utf-8').close()
+            self.journal_size = 0
+            self.journal_corrupt = False
+            # 日志清空后旧代的正文文件不再被引用
+            for generation in self.body_generations():
+                if generation != self.generation:
+                    self.remove_body_file(generation)
+
+    def needs_body_rewrite(self):
+        # 还引用旧代文件，或当前文件中失效的段超过一半时重写
+        live = 0
+        for generation, _, length in self.body_index.values():
+            if generation != self.generation:
+                return True
+            live += length
+        try:
+            size = os.path.getsize(self.body_path(self.generation))
+        except OSError:
+            return False
+        return size >= JOURNAL_COMPACT_BYTES and live * 2 < size
+
+    def rewrite_bodies(self):
+        # 把仍在使用的段按顺序复制到下一代文件
+        generation = self.generation + 1
+        path = self.body_path(generation)
+        index = {}
+        with open(path, 'wb') as f:
+            for note_id, pointer in self.body_index.items():
+                data = self.read_segment(pointer)
+                index[note_id] = (generation, f.tell(), len(data))
+                f.write(data)
+        self.body_index = index
+        self.generation = generation
+
+    def remove_body_file(self, generation):
+        body_map = self.body_maps.pop(generation, None)
+        if body_map is not None:
+            body_map.close()
+        try:
+            os.remove(self.body_path(generation))
+        except OSError as e:
+            print(f"Error removing {self.body_path(generation)}: {e}")
+
+    def exists(self):
+        return bool(self.shard_keys()) or any(
+            os.path.exists(path) for path in (self.snapshot_file, self.data_file, self.journal_file))
+
+    def retire(self):
+        # 迁移到其他后端后保留旧文件作为备份
+        paths = [self.snapshot_file, self.data_file, self.journal_file]
+        paths += [self.shard_path(key) for key in self.shard_keys()]
+        paths += [self.body_path(generation) for generation in self.body_generations()]
+        self.close()
+        for path in paths:
+            if os.path.exists(path):
+                os.replace(path, path + '.migrated')
+
+    def close(self):
+        with self.body_lock:
+            for body_map in self.body_maps.values():
+                body_map.close()
+            self.body_maps = {}
+
+class SqliteNoteStorage(NoteStorage):
+    """基于 sqlite3 的存储后端，每次变更只更新一行"""
+    # 有独立列的字段，其余字段以 JSON 形式存放在 extra 列
+    COLUMNS = ('title', 'content', 'timestamp', 'is_pinned', 'is_deleted',
+               'pin_time', 'create_time', 'background_color', 'plain_text')
+    # 分页加载时只读取元数据列
+    META_COLUMNS = tuple(name for name in COLUMNS if name not in BODY_FIELDS)
+
+    def __init__(self, data_dir):
+        self.db_file = os.path.join(data_dir, 'notes.db')
+        # 连接在主线程中创建，之后只由后台写入线程使用
+        self.conn = sqlite3.connect(self.db_file, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.create_schema()
+        # 按需读取正文的独立连接，调用方负责串行访问
+        self.read_conn = sqlite3.connect(self.db_file, check_same_thread=False)
+
+    def create_schema(self):
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS notes (
+                    id INTEGER PRIMARY KEY,
+                    position INTEGER NOT NULL DEFAULT 0,
+                    title TEXT NOT NULL DEFAULT '',
+                    content TEXT NOT NULL DEFAULT '',
+                    timestamp TEXT NOT NULL DEFAULT '',
+                    is_pinned INTEGER NOT NULL DEFAULT 0,
+                    is_deleted INTEGER NOT NULL DEFAULT 0,
+                    pin_time REAL,
+                    create_time REAL,
+                    background_color TEXT,
+                    extra TEXT NOT NULL DEFAULT '{}',
+                    plain_text TEXT
+                )
+            """)
+            self.conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_notes_pinned ON notes(is_deleted, is_pinned, pin_time)')
+            self.conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_notes_create_time ON notes(is_deleted, create_time)')
+            columns = [row[1] for row in self.conn.execute('PRAGMA table_info(notes)')]
+            if 'plain_text' not in columns:
+                self.migrate_plain_text()
+
+    def migrate_plain_text(self):
+        # 旧版本把纯文本放在 extra 中，移到单独的列，加载元数据时不必读取
+        self.conn.execute('ALTER TABLE notes ADD COLUMN plain_text TEXT')
+        rows = self.conn.execute(
+            "SELECT id, extra FROM notes WHERE extra LIKE '%\"plain_text\"%'").fetchall()
+        updates = []
+        for note_id, extra in rows:
+            extra = json.loads(extra)
+            plain_text = extra.pop('plain_text', None)
+            if plain_text is not None:
+                updates.append((plain_text, json.dumps(extra, ensure_ascii=False), note_id))
+        self.conn.executemany('UPDATE notes SET plain_text = ?, extra = ? WHERE id = ?', updates)
+
+    @staticmethod
+    def exists_in(data_dir):
+        return os.path.exists(os.path.join(data_dir, 'notes.db'))
+
+    def is_empty(self):
+        return self.conn.execute('SELECT 1 FROM notes LIMIT 1').fetchone() is None
+
+    def row_to_note(self, row, columns=COLUMNS):
+        note = json.loads(row[-1])
+        note['id'] = row[0]
+        for name, value in zip(columns, row[1:-1]):
+            if name in ('is_pinned', 'is_deleted'):
+                value = bool(value)
+            elif value is None:
+                # 可空列为空表示便签没有该字段
+                continue
+            elif name == 'content':
+                value = ContentCodec.unpack(value)
+            note[name] = value
+        return note
+
+    def select_sql(self, columns=COLUMNS):
+        return 'SELECT id, ' + ', '.join(columns) + ', extra FROM notes'
+
+    def load(self):
+        notes = []
+        try:
+            cursor = self.conn.execute(self.select_sql() + ' ORDER BY position, id')
+            notes = [self.row_to_note(row) for row in cursor]
+        except Exception as e:
+            print(f"Error loading notes: {e}")
+        return notes
+
+    def load_pages(self, page_size):
+        # 用独立连接在同一个读快照中按显示顺序分页：先置顶，再未置顶，最后是已删除的便签；
+        # 每个便签带有存储顺序 'position'，由调用方在全部加载后恢复拖动排序
+        columns = ('position',) + self.META_COLUMNS
+        conn = sqlite3.connect(self.db_file)
+        try:
+            conn.execute('BEGIN')
+            for condition in ('is_deleted = 0 AND is_pinned = 1 ORDER BY pin_time DESC, id',
+                              'is_deleted = 0 AND is_pinned = 0 ORDER BY create_time DESC, id',
+                              'is_deleted = 1 ORDER BY id'):
+                cursor = conn.execute(self.select_sql(columns) + ' WHERE ' + condition)
+                while True:
+                    rows = cursor.fetchmany(page_size)
+                    if not rows:
+                        break
+                    yield [self.row_to_note(row, columns) for row in rows]
+        except Exception as e:
+            print(f"Error loading notes: {e}")
+        finally:
+            conn.close()
+
+    def load_body(self, note_id):
+        row = self.read_conn.execute(
+            'SELECT ' + ', '.join(BODY_FIELDS) + ' FROM notes WHERE id = ?', (note_id,)).fetchone()
+        if row is None:
+            return {}
+        body = {name: value for name, value in zip(BODY_FIELDS, row) if value is not None}
+        if 'content' in body:
+            body['content'] = ContentCodec.unpack(body['content'])
+        return body
+
+    def max_id(self):
+        row = self.conn.execute('SELECT MAX(id) FROM notes').fetchone()
+        return -1 if row[0] is None else row[0]
+
+    def split_fields(self, fields):
+        columns = {k: v for k, v in fields.items() if k in self.COLUMNS}
+        if isinstance(columns.get('content'), str):
+            # 正文以 ContentCodec 编码，较大的正文以压缩后的 BLOB 保存
+            columns['content'] = ContentCodec.pack(columns['content'])
+        extra = {k: v for k, v in fields.items() if k not in self.COLUMNS and k != 'id'}
+        return columns, extra
+
+    def insert_note(self, note, position=None):
+        # 不指定位置时排在最后
+        columns, extra = self.split_fields(note)
+        names = ['id', 'position'] + list(columns) + ['extra']
+        values = [note['id']] + list(columns.values()) + [json.dumps(extra, ensure_ascii=False)]
+        if position is None:
+            position_sql = '(SELECT COALESCE(MAX(position), -1) + 1 FROM notes)'
+        else:
+            position_sql = '?'
+            values.insert(1, position)
+        self.conn.execute(
+            'INSERT OR REPLACE INTO notes (' + ', '.join(names) + ') VALUES (?, ' + position_sql +
+            ', ' + ', '.join('?' * (len(names) - 2)) + ')',
+            values)
+
+    def update_note(self, note_id, fields):
+        columns, extra = self.split_fields(fields)
+        if extra:
+            row = self.conn.execute('SELECT extra FROM notes WHERE id = ?', (note_id,)).fetchone()
+            if row is None:
+                return
+            merged = json.loads(row[0])
+            merged.update(extra)
+            columns['extra'] = json.dumps(merged, ensure_ascii=False)
+        if columns:
+            self.conn.execute(
+                'UPDATE notes SET ' + ', '.join(f'{name} = ?' for name in columns) + ' WHERE id = ?',
+                list(columns.values()) + [note_id])
+
+    def write(self, records):
+        # 一批记录在同一个事务中提交
+        with self.conn:
+            for record in records:
+                op = record.get('op')
+                if op == 'add':
+                    self.insert_note(record['note'])
+                elif op == 'set':
+                    self.update_note(record['id'], record['fields'])
+                elif op == 'order':
+                    self.conn.executemany(
+                        'UPDATE notes SET position = ? WHERE id = ?',
+                        [(position, note_id) for position, note_id in enumerate(record['ids'])])
+
+    def compact(self, notes):
+        # 快照包含全部便签的元数据（后台写入线程会丢弃快照之前的记录）：在一个事务中
+        # 删除快照中没有的行并重写元数据，快照中带正文的便签同时更新正文，再回收空间
+        meta_columns = self.META_COLUMNS
+        with self.conn:
+            existing = {row[0] for row in self.conn.execute('SELECT id FROM notes')}
+            kept = {note['id'] for note in notes}
+            self.conn.executemany('DELETE FROM notes WHERE id = ?',
+                                  [(note_id,) for note_id in existing - kept])
+            updates = []
+            for position, note in enumerate(notes):
+                if note['id'] not in existing:
+                    self.insert_note(note, position)
+                    continue
+                columns, extra = self.split_fields(note)
+                values = [columns.get(name) for name in meta_columns]
+                for i, name in enumerate(meta_columns):
+                    # 非空列缺少字段时使用列的默认值
+                    if name in ('is_pinned', 'is_deleted'):
+                        values[i] = bool(values[i])
+                    elif name in ('title', 'timestamp') and values[i] is None:
+                        values[i] = ''
+                updates.append([position] + values +
+                               [json.dumps(extra, ensure_ascii=False), note['id']])
+                _, body = split_body(note)
+                if body:
+                    self.update_note(note['id'], body)
+            self.conn.executemany(
+                'UPDATE notes SET position = ?, ' +
+                ', '.join(f'{name} = ?' for name in meta_columns) + ', extra = ? WHERE id = ?',
+                updates)
+        self.conn.execute('VACUUM')
+        self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def migrate_from_json(self, json_storage):
+        # 一次性从 notes.json（含变更日志）导入，全部写入在同一个事务中完成
+        notes = json_storage.load()
+        try:
+            with self.conn:
+                for note in notes:
+                    note.setdefault('is_deleted', False)
+                    note.setdefault('is_pinned', False)
+                    self.insert_note(note)
+        except Exception as e:
+            print(f"Error migrating notes: {e}")
+            return False
+        json_storage.retire()
+        print(f"Migrated {len(notes)} notes to {self.db_file}")
+        return True
+
+    def close(self):
+        self.read_conn.close()
+        self.conn.close()
+
+class BackgroundSaver:
+    """后台写入线程：合并一段时间内的连续修改，在工作线程中批量落盘"""
+    def __init__(self, storage, delay=SAVE_DELAY):
+        self.storage = storage
+        self.delay = delay
+        self.on_saved = None
+        self.on_error = None
+        self.cond = threading.Condition()
+        self.pending = []
+        # 便签ID -> 待写入的 add/set 记录，用于合并同一便签的多次修改
+        self.pending_by_id = {}
+        self.snapshot = None
+        self.snapshot_busy = False
+        # 被快照取代、不再写入的记录，合并快照前交给存储后端
+        self.discarded = []
+        self.writing = False
+        # 已提交的修改数，以及已写入磁盘的修改数（按提交顺序）
+        self.submitted = 0
+        self.written = 0
+        self.failures = 0
+        self.flush_requested = False
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, name='NoteSaver', daemon=True)
+        self.thread.start()
+
+    def submit(self, record):
+        with self.cond:
+            self.submitted += 1
+            op = record['op']
+            if op == 'set':
+                previous = self.pending_by_id.get(record['id'])
+                if previous is not None:
+                    # 同一便签的修改合并到尚未写入的记录中
+                    target = previous['note'] if previous['op'] == 'add' else previous['fields']
+                    target.update(record['fields'])
+                    return
+                self.pending_by_id[record['id']] = record
+            elif op == 'add':
+                self.pending_by_id[record['note']['id']] = record
+            elif op == 'order':
+                # 只保留最新的排序
+                self.pending = [r for r in self.pending if r['op'] != 'order']
+            self.pending.append(record)
+            self.cond.notify_all()
+
+    def submit_snapshot(self, notes):
+        # 快照已包含此前所有修改，丢弃尚未写入的记录；notes 也可以是在写入线程中
+        # 生成快照的函数
+        with self.cond:
+            self.submitted += 1
+            self.snapshot = notes
+            self.snapshot_busy = True
+            self.discarded += self.pending
+            self.pending = []
+            self.pending_by_id = {}
+            self.cond.notify_all()
+
+    def has_pending(self):
+        return bool(self.pending) or self.snapshot is not None
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.has_pending() and not self.stopping:
+                    self.cond.wait()
+                if not self.has_pending():
+                    break
+                # 合并窗口：收到第一条修改后再等待一段时间收集后续修改
+                deadline = time.monotonic() + self.delay
+                while not self.stopping and not self.flush_requested:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                records, snapshot, discarded = self.pending, self.snapshot, self.discarded
+                self.pending, self.pending_by_id, self.snapshot = [], {}, None
+                self.discarded = []
+                batch = self.submitted
+                self.writing = True
+            error = None
+            try:
+                if discarded:
+                    self.storage.discard(discarded)
+                if callable(snapshot):
+                    # 写入失败时放回队列的是已生成的快照
+                    snapshot = snapshot()
+                if snapshot is not None:
+                    self.storage.compact(snapshot)
+                if records:
+                    self.storage.write(records)
+            except Exception as e:
+                error = str(e)
+                print(f"Error saving notes: {e}")
+            with self.cond:
+                if error is not None:
+                    self.failures += 1
+                    # 写入失败的内容放回队列，下次写入时重试（若期间已提交新快照则无需重试）
+                    if self.snapshot is None:
+                        self.snapshot = snapshot
+                        self.pending = records + self.pending
+                        for record in records:
+                            key = record['note']['id'] if record['op'] == 'add' else record.get('id')
+                            if key is not None:
+                                self.pending_by_id.setdefault(key, record)
+                else:
+                    self.written = batch
+                    if snapshot is not None and self.snapshot is None:
+                        self.snapshot_busy = False
+                self.writing = False
+                self.cond.notify_all()
+            if error is None:
+                if self.on_saved is not None:
+                    self.on_saved()
+                continue
+            if self.on_error is not None:
+                self.on_error(error)
+            if self.stopping:
+                break
+            # 出错后稍后再重试，避免反复报错
+            with self.cond:
+                self.cond.wait(SAVE_RETRY_DELAY)
+
+    def flush(self):
+        # 阻塞直到所有修改写入完毕（或写入失败）
+        with self.cond:
+            failures = self.failures
+            self.flush_requested = True
+            self.cond.notify_all()
+            while ((self.has_pending() or self.writing) and self.failures == failures
+                   and self.thread.is_alive()):
+                self.cond.wait(0.1)
+            self.flush_requested = False
+
+    def stop(self):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        self.thread.join()
+
+def open_storage(data_dir, backend=None):
+    backend = backend or STORAGE_BACKEND
+    if backend == 'sqlite' or SqliteNoteStorage.exists_in(data_dir):
+        storage = SqliteNoteStorage(data_dir)
+        json_storage = JsonNoteStorage(data_dir)
+        if storage.is_empty() and json_storage.exists():
+            storage.migrate_from_json(json_storage)
+        return storage
+    return JsonNoteStorage(data_dir)
+
+def sorted_position(keys, ids, key, note_id):
+    # keys 和 ids 是按 (键, 便签ID) 排序的平行数组，返回 (key, note_id) 的插入位置
+    lo = bisect.bisect_left(keys, key)
+    hi = bisect.bisect_right(keys, key, lo)
+    return bisect.bisect_left(ids, note_id, lo, hi)
+
+def insert_sorted(keys, ids, entries):
+    # 把 (键, 便签ID) 列表插入按 (键, 便签ID) 排序的平行数组 keys 和 ids
+    if len(entries) * 8 > len(keys):
+        # 条目较多时（如启动时一次加载全部便签）合并后整体排序
+        entries.extend(zip(keys, ids))
+        entries.sort()
+        keys[:] = array(keys.typecode, [key for key, _ in entries])
+        ids[:] = array(ids.typecode, [note_id for _, note_id in entries])
+        return
+    # 否则从后往前插入，插入位置相同的连续条目一次插入
+    entries.sort(reverse=True)
+    i = 0
+    while i < len(entries):
+        position = sorted_position(keys, ids, *entries[i])
+        j = i + 1
+        if position == 0:
+            j = len(entries)
+        else:
+            # 大于插入点前一个元素的条目都插在同一位置
+            floor = (keys[position - 1], ids[position - 1])
+            while j < len(entries) and entries[j] > floor:
+                j += 1
+        block = entries[i:j][::-1]
+        keys[position:position] = array(keys.typecode, [key for key, _ in block])
+        ids[position:position] = array(ids.typecode, [note_id for _, note_id in block])
+        i = j
+
+class Note:
+    """内存中的便签元数据
+
+    字段保存在 __slots__ 中而不是每个便签一个 dict；ID、置顶和删除标志以及各个时间
+    保存在 NoteTable 的列中，按行号访问。提供 dict 的常用接口（note['title']、get、
+    update、in、dict(note)），未设置的字段视为不存在，不认识的字段保存在 extra 中。
+    """
+    __slots__ = ('table', 'row', 'title', 'timestamp', 'background_color',
+                 'preview', 'images', 'text_crc', 'extra')
+    SLOT_FIELDS = ('title', 'timestamp', 'background_color', 'preview', 'images', 'text_crc')
+    SLOT_SET = frozenset(SLOT_FIELDS)
+    # 不需要转换、直接保存的字段
+    PLAIN_SLOTS = ('title', 'background_color', 'preview', 'text_crc')
+    MISSING = object()
+
+    def __init__(self, table, row, fields):
+        # 列中的字段由 NoteTable 写入，这里只保存其余字段
+        self.table = table
+        self.row = row
+        self.extra = None
+        get = fields.get
+        missing = Note.MISSING
+        for name in Note.PLAIN_SLOTS:
+            value = get(name, missing)
+            if value is not missing:
+                setattr(self, name, value)
+        timestamp = get('timestamp', missing)
+        if timestamp is not missing:
+            self.set_slot('timestamp', timestamp)
+        images = get('images', missing)
+        if images is not missing:
+            self.images = tuple(images) if images else ()
+        if not NoteTable.KNOWN_FIELDS.issuperset(fields):
+            self.extra = {name: value for name, value in fields.items()
+                          if name not in NoteTable.KNOWN_FIELDS}
+
+    def get(self, name, default=None):
+        if name in Note.SLOT_SET:
+            return getattr(self, name, default)
+        table = self.table
+        if name == 'id':
+            return table.ids[self.row]
+        flag = NoteTable.FLAGS.get(name)
+        if flag is not None:
+            return bool(table.flags[self.row] & flag)
+        if name in NoteTable.TIMES:
+            value = getattr(table, name)[self.row]
+            # NaN 表示没有这个字段
+            return default if value != value else value
+        if self.extra:
+            return self.extra.get(name, default)
+        return default
+
+    def __getitem__(self, name):
+        if name in Note.SLOT_SET:
+            try:
+                return getattr(self, name)
+            except AttributeError:
+                raise KeyError(name) from None
+        if name == 'id':
+            return self.table.ids[self.row]
+        value = self.get(name, Note.MISSING)
+        if value is Note.MISSING:
+            raise KeyError(name)
+        return value
+
+    def set_slot(self, name, value):
+        if name == 'timestamp' and isinstance(value, str):
+            # 时间戳只有 HH:MM 几种取值，共用同一个字符串
+            value = sys.intern(value)
+        elif name == 'images':
+            value = tuple(value) if value else ()
+        setattr(self, name, value)
+
+    def __setitem__(self, name, value):
+        if name in Note.SLOT_SET:
+            self.set_slot(name, value)
+            return
+        table = self.table
+        if name == 'id':
+            table.ids[self.row] = value
+            return
+        flag = NoteTable.FLAGS.get(name)
+        if flag is not None:
+            table.set_flag(self.row, flag, value)
+        elif name in NoteTable.TIMES:
+            getattr(table, name)[self.row] = math.nan if value is None else value
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[name] = value
+
+    def __contains__(self, name):
+        return self.get(name, Note.MISSING) is not Note.MISSING
+
+    def keys(self):
+        keys = ['id', 'is_pinned', 'is_deleted']
+        keys.extend(name for name in NoteTable.TIMES if name in self)
+        keys.extend(name for name in Note.SLOT_FIELDS if hasattr(self, name))
+        if self.extra:
+            keys.extend(self.extra)
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(name, self[name]) for name in self.keys()]
+
+    def update(self, fields):
+        for name, value in fields.items():
+            self[name] = value
+
+    def setdefault(self, name, default=None):
+        value = self.get(name, Note.MISSING)
+        if value is Note.MISSING:
+            self[name] = value = default
+        return value
+
+    def __repr__(self):
+        return f'Note({dict(self)!r})'
+
+class NoteTable:
+    """便签元数据的列式存储
+
+    ID、标志位（置顶、已删除、在显示顺序中、空行）和创建、置顶、删除时间保存在按行对齐的
+    array / bytearray 中，其余字段在 Note 对象中；按标志筛选时整列转换，不逐个访问便签。
+    行只追加，不移动也不复用，后台线程持有的行号始终有效；被清除的便签只把行标记为空。
+    """
+    PINNED = 1
+    DELETED = 2
+    ORDERED = 4
+    VACANT = 8
+    FLAGS = {'is_pinned': PINNED, 'is_deleted': DELETED}
+    TIMES = ('create_time', 'pin_time', 'delete_time')
+    COLUMN_FIELDS = frozenset(('id',) + tuple(FLAGS) + TIMES)
+    KNOWN_FIELDS = COLUMN_FIELDS | Note.SLOT_SET
+
+    def __init__(self):
+        self.ids = array('q')
+        self.flags = bytearray()
+        self.create_time = array('d')
+        self.pin_time = array('d')
+        self.delete_time = array('d')
+        # 行号 -> Note，空行为 None
+        self.notes = []
+        self.by_id = {}
+        # (mask, value) -> bytes.translate 使用的转换表
+        self.selectors = {}
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def append(self, fields):
+        # 由便签的 dict 新建一行，返回对应的 Note
+        return self.extend((fields,))[0]
+
+    def extend(self, page):
+        # 由便签的 dict 批量新建行，返回对应的 Note 列表；各列一次追加
+        row = len(self.notes)
+        ids = [fields['id'] for fields in page]
+        self.ids.extend(ids)
+        pinned, deleted = self.PINNED, self.DELETED
+        self.flags.extend([(pinned if fields.get('is_pinned') else 0) |
+                           (deleted if fields.get('is_deleted') else 0) for fields in page])
+        for name in self.TIMES:
+            # NaN 表示没有这个字段
+            getattr(self, name).extend([math.nan if fields.get(name) is None else fields[name]
+                                        for fields in page])
+        notes = [Note(self, row + i, fields) for i, fields in enumerate(page)]
+        self.notes.extend(notes)
+        self.by_id.update(zip(ids, notes))
+        return notes
+
+    def remove(self, note):
+        # 行中的数据保留，移除后的 Note 仍可读取
+        self.flags[note.row] |= self.VACANT
+        self.notes[note.row] = None
+        del self.by_id[note['id']]
+
+    def set_flag(self, row, flag, value):
+        if value:
+            self.flags[row] |= flag
+        else:
+            self.flags[row] &= ~flag & 0xFF
+
+    def select(self, mask, value):
+        # 标志位 & mask == value 的行为 1，其余为 0，可直接用于 itertools.compress
+        selector = self.selectors.get((mask, value))
+        if selector is None:
+            selector = bytes(1 if flags & mask == value else 0 for flags in range(256))
+            self.selectors[(mask, value)] = selector
+        return self.flags.translate(selector)
+
+    def active_notes(self):
+        return list(compress(self.notes, self.select(self.DELETED | self.VACANT, 0)))
+
+    def rows(self, notes):
+        # 返回与 dict(note) 相同的 dict 列表：各列整列转换后按行号读取，字段直接取自
+        # __slots__，不经过 Note 的 dict 接口；可在后台线程中调用
+        ids = self.ids.tolist()
+        flags = bytes(self.flags)
+        times = [(name, getattr(self, name).tolist()) for name in self.TIMES]
+        slots = Note.SLOT_FIELDS
+        missing = Note.MISSING
+        pinned, deleted = self.PINNED, self.DELETED
+        rows = []
+        for note in notes:
+            row = note.row
+            bits = flags[row]
+            fields = {'id': ids[row], 'is_pinned': bool(bits & pinned),
+                      'is_deleted': bool(bits & deleted)}
+            for name, column in times:
+                value = column[row]
+                # NaN 表示没有这个字段
+                if value == value:
+                    fields[name] = value
+            for name in slots:
+                value = getattr(note, name, missing)
+                if value is not missing:
+                    fields[name] = value
+            if note.extra:
+                fields.update(note.extra)
+            rows.append(fields)
+        return rows
+
+    def deleted_ids(self):
+        return compress(self.ids, self.select(self.DELETED | self.VACANT, self.DELETED))
+
+class NoteOrder:
+    """按显示顺序维护的有序索引
+
+    置顶便签按置顶时间、非置顶便签按创建时间排列，新的在前，时间相同时按ID排列。
+    每组的排序键和便签ID保存在平行的数组中，通过二分查找增删，无需每次重新排序；
+    便签是否在索引中记录在 NoteTable 的标志位中。
+    """
+    def __init__(self, table):
+        self.table = table
+        self.pinned_keys = array('d')  # -pin_time
+        self.pinned_ids = array('q')
+        self.unpinned_keys = array('d')  # -create_time
+        self.unpinned_ids = array('q')
+
+    def key_of(self, note):
+        # 直接读取列，缺少的时间（NaN）按 0 处理
+        table, row = self.table, note.row
+        is_pinned = bool(table.flags[row] & NoteTable.PINNED)
+        value = table.pin_time[row] if is_pinned else table.create_time[row]
+        return is_pinned, -value if value == value else 0.0
+
+    def columns(self, is_pinned):
+        if is_pinned:
+            return self.pinned_keys, self.pinned_ids
+        return self.unpinned_keys, self.unpinned_ids
+
+    def __len__(self):
+        return len(self.pinned_ids) + len(self.unpinned_ids)
+
+    def __contains__(self, note_id):
+        note = self.table.by_id.get(note_id)
+        return note is not None and bool(self.table.flags[note.row] & NoteTable.ORDERED)
+
+    def add(self, note):
+        self.add_many((note,))
+
+    def add_many(self, notes):
+        groups = ([], [])
+        for note in notes:
+            is_pinned, key = self.key_of(note)
+            groups[is_pinned].append((key, note['id']))
+            self.table.set_flag(note.row, NoteTable.ORDERED, True)
+        for is_pinned, entries in enumerate(groups):
+            insert_sorted(*self.columns(is_pinned), entries)
+
+    def remove(self, note_id):
+        # 需要在修改便签的排序字段之前调用
+        note = self.table.by_id.get(note_id)
+        if note_id not in self:
+            return
+        is_pinned, key = self.key_of(note)
+        keys, ids = self.columns(is_pinned)
+        i = sorted_position(keys, ids, key, note_id)
+        if i >= len(ids) or ids[i] != note_id:
+            i = ids.index(note_id)
+        del keys[i]
+        del ids[i]
+        self.table.set_flag(note.row, NoteTable.ORDERED, False)
+
+    def index(self, note_id):
+        # 便签在显示顺序中的位置
+        note = self.table.by_id[note_id]
+        is_pinned, key = self.key_of(note)
+        keys, ids = self.columns(is_pinned)
+        position = sorted_position(keys, ids, key, note_id)
+        return position if is_pinned else len(self.pinned_ids) + position
+
+    def id_at(self, position):
+        if position < len(self.pinned_ids):
+            return self.pinned_ids[position]
+        return self.unpinned_ids[position - len(self.pinned_ids)]
+
+    def ids(self):
+        yield from self.pinned_ids
+        yield from self.unpinned_ids
+
+    def id_list(self):
+        return self.pinned_ids.tolist() + self.unpinned_ids.tolist()
+
+class NoteQuery:
+    """结构化查询
+
+    以空格分隔的子句，例如 ``title:会议 pinned:yes color:#ffeeaa created:>2026-01-01 -deleted``。
+    支持的字段：id、title、pinned、color、created、deleted，其余词在标题和正文中查找；
+    子句前加 - 表示取反，单独的 pinned / deleted 等同于 pinned:yes / deleted:yes。
+    created 的值为日期（YYYY-MM-DD），可带 >、>=、<、<=、= 前缀。
+    """
+    FIELDS = ('id', 'title', 'pinned', 'color', 'created', 'deleted')
+    FLAGS = ('pinned', 'deleted')
+    YES = ('yes', 'y', 'true', '1', '是')
+    NO = ('no', 'n', 'false', '0', '否')
+
+    def __init__(self, text):
+        # (是否取反, 字段, 值)，字段为 None 表示全文
+        self.clauses = []
+        # 是否查找已删除的便签，最后出现的 deleted 子句生效
+        self.deleted = False
+        for token in text.lower().split():
+            negated = token.startswith('-') and len(token) > 1
+            if negated:
+                token = token[1:]
+            clause = self.parse_clause(token)
+            if clause is None:
+                self.clauses.append((negated, None, token))
+            elif clause[0] == 'deleted':
+                self.deleted = clause[1] != negated
+            else:
+                self.clauses.append((negated,) + clause)
+
+    def parse_clause(self, token):
+        # 返回 (字段, 值)；不是字段子句或值无法解析时返回 None，按全文处理
+        if token in self.FLAGS:
+            return token, True
+        field, sep, value = token.partition(':')
+        if not sep or field not in self.FIELDS or not value:
+            return None
+        if field == 'id':
+            return (field, int(value)) if value.isdigit() else None
+        if field in self.FLAGS:
+            if value in self.YES:
+                return field, True
+            if value in self.NO:
+                return field, False
+            return None
+        if field == 'created':
+            created = self.parse_date_range(value)
+            return (field, created) if created else None
+        return field, value
+
+    @staticmethod
+    def parse_date_range(value):
+        # 返回创建时间的范围 [start, end)
+        op = ''
+        while value and value[0] in '<>=':
+            op += value[0]
+            value = value[1:]
+        try:
+            day = datetime.strptime(value, '%Y-%m-%d')
+        except ValueError:
+            return None
+        start = day.timestamp()
+        end = (day + timedelta(days=1)).timestamp()
+        ranges = {
+            '': (start, end), '=': (start, end),
+            '>': (end, math.inf), '>=': (start, math.inf),
+            '<': (-math.inf, start), '<=': (-math.inf, end),
+        }
+        return ranges.get(op)
+
+    def terms(self):
+        # 不取反的全文查询词，用于相关度排序
+        return [value for negated, field, value in self.clauses if field is None and not negated]
+
+    def filters(self):
+        # 去掉全文查询词后的查询，按相关度排序时只用它缩小范围
+        query = NoteQuery('')
+        query.deleted = self.deleted
+        query.clauses = [clause for clause in self.clauses if clause[1] is not None or clause[0]]
+        return query
+
+    def is_empty(self):
+        return not self.clauses and not self.deleted
+
+    @staticmethod
+    def clause_matches(field, value, note, text):
+        # text 为小写的 标题\n正文
+        if field is None:
+            return value in text
+        if field == 'title':
+            return value in text.partition('\n')[0]
+        if field == 'id':
+            return note['id'] == value
+        if field == 'pinned':
+            return bool(note.get('is_pinned', False)) == value
+        if field == 'color':
+            return (note.get('background_color') or '').lower() == value
+        if field == 'created':
+            return value[0] <= (note.get('create_time') or 0) < value[1]
+        return False
+
+    def matches(self, note, text):
+        if bool(note.get('is_deleted', False)) != self.deleted:
+            return False
+        return all(self.clause_matches(field, value, note, text) != negated
+                   for negated, field, value in self.clauses)
+
+class AttributeIndex:
+    """结构化查询使用的属性索引，包含已加载的全部便签（含已删除）
+
+    删除状态直接按 NoteTable 的标志位筛选，不另外建索引。
+    """
+    def __init__(self):
+        # 颜色 -> 便签ID集合
+        self.colors = {}
+        self.note_colors = {}
+        # 按 (-创建时间, 便签ID) 排序的平行数组，与显示顺序一样新的在前
+        self.created_keys = array('d')
+        self.created_ids = array('q')
+
+    def add(self, note):
+        self.add_many((note,))
+
+    def add_many(self, notes):
+        keys, ids = self.created_keys, self.created_ids
+        unordered = []
+        for note in notes:
+            note_id = note['id']
+            color = note.get('background_color')
+            if color:
+                self.set_color(note_id, color)
+            key = -(note.get('create_time') or 0)
+            if not keys or (key, note_id) > (keys[-1], ids[-1]):
+                # 按显示顺序分页加载的便签都在末尾，无需移动元素
+                keys.append(key)
+                ids.append(note_id)
+            else:
+                unordered.append((key, note_id))
+        if unordered:
+            insert_sorted(keys, ids, unordered)
+
+    def remove(self, note):
+        note_id = note['id']
+        self.set_color(note_id, None)
+        keys, ids = self.created_keys, self.created_ids
+        i = sorted_position(keys, ids, -(note.get('create_time') or 0), note_id)
+        if i < len(ids) and ids[i] == note_id:
+            del keys[i]
+            del ids[i]
+
+    def set_color(self, note_id, color):
+        old = self.note_colors.pop(note_id, None)
+        if old is not None:
+            self.colors[old].discard(note_id)
+        if color:
+            color = color.lower()
+            self.note_colors[note_id] = color
+            self.colors.setdefault(color, set()).add(note_id)
+
+    def created_range(self, start, end):
+        # 返回创建时间落在 [start, end) 内的下标范围，即键落在 (-end, -start] 内
+        keys = self.created_keys
+        return bisect.bisect_right(keys, -end), bisect.bisect_right(keys, -start)
+
+class ImageStore:
+    """按内容寻址的图片存储
+
+    图片按内容的 SHA-256 命名，逐字节复制而不重新编码，相同的图片只保存一份。
+    没有便签引用的图片由 sweep 按便签内容标记后清除。
+    """
+    IMG_SRC = re.compile(r'<img\b[^>]*?\bsrc="([^"]*)"', re.IGNORECASE)
+
+    def __init__(self, images_dir):
+        self.images_dir = images_dir
+        # 处理插入图片的进程池，第一次插入时创建
+        self.executor = None
+
+    @staticmethod
+    def file_hash(path):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(IMAGE_HASH_CHUNK), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def add_file(self, path):
+        # 返回图片在存储中的路径；复制到临时文件的同时计算哈希，只读一遍原图，
+        # 再按哈希改名。临时文件名包含进程和线程，同时插入的图片不会互相覆盖
+        temp_file = os.path.join(self.images_dir, f'.{os.getpid()}-{threading.get_ident()}.tmp')
+        digest = hashlib.sha256()
+        with open(path, 'rb') as source, open(temp_file, 'wb') as f:
+            for chunk in iter(lambda: source.read(IMAGE_HASH_CHUNK), b''):
+                digest.update(chunk)
+                f.write(chunk)
+        target = os.path.join(self.images_dir, digest.hexdigest() + os.path.splitext(path)[1].lower())
+        if os.path.exists(target):
+            os.remove(temp_file)
+            # 更新修改时间，清理时不会删除刚被再次插入的图片
+            os.utime(target)
+        else:
+            os.replace(temp_file, target)
+        return target
+
+    def ingest(self, path):
+        # 在进程池中处理插入的图片，返回结果为处理报告的 Future；
+        # 没有 Pillow 时原样复制，返回已完成的 Future
+        if Image is None:
+            future = Future()
+            start = time.perf_counter()
+            try:
+                target = self.add_file(path)
+                future.set_result({
+                    'path': target, 'original_bytes': os.path.getsize(path),
+                    'stored_bytes': os.path.getsize(target), 'seconds': time.perf_counter() - start,
+                    'cached': False, 'converted': False,
+                })
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        if self.executor is None:
+            # 界面、保存和搜索线程都在运行，用 spawn 启动子进程，不 fork 多线程的进程
+            self.executor = ProcessPoolExecutor(max_workers=INGEST_PROCESSES,
+                                                mp_context=multiprocessing.get_context('spawn'))
+        return self.executor.submit(ingest_image, path, self.images_dir)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+
+    def image_names(self, content):
+        # 便签内容引用的、位于图片目录中的图片文件名（按出现顺序，不重复）
+        if '<img' not in content:
+            return []
+        names = {}
+        for src in self.IMG_SRC.findall(content):
+            # toHtml() 会把路径中的 & 等字符写成实体；file:// 地址中的字符是百分号编码的
+            src = unescape(src)
+            if src.startswith('file://'):
+                src = unquote(urlsplit(src).path)
+            directory, name = os.path.split(os.path.normpath(src))
+            if directory == self.images_dir:
+                names[name] = True
+        return list(names)
+
+    def sweep(self, marked, thumbs_dir=None, grace=GC_IMAGE_GRACE):
+        # 标记-清除：marked 为从便签内容中解析出的仍被引用的图片文件名，删除图片目录、
+        # originals 和缩略图目录中未被引用且超过 grace 秒未修改的文件，可在后台线程中调用。
+        # 返回 (删除的文件数, 释放的字节数)
+        # 保留原图和缩略图按被引用图片的哈希（文件名去掉扩展名和处理参数）匹配
+        stems = {os.path.splitext(name)[0] for name in marked}
+        hashes = {stem.split('_')[0] for stem in stems}
+        originals_dir = os.path.join(self.images_dir, 'originals')
+        sweeps = [
+            (self.images_dir, lambda name: name in marked),
+            (originals_dir, lambda name: os.path.splitext(name)[0] in hashes),
+        ]
+        if thumbs_dir is not None:
+            sweeps.append((thumbs_dir, lambda name: name.rsplit('_', 1)[0] in stems))
+        cutoff = time.time() - grace
+        removed = freed = 0
+        for directory, is_marked in sweeps:
+            if not os.path.isdir(directory):
+                continue
+            for entry in os.scandir(directory):
+                if not entry.is_file() or is_marked(entry.name):
+                    continue
+                try:
+                    stat = entry.stat()
+                    if stat.st_mtime > cutoff:
+                        continue
+                    os.remove(entry.path)
+                except OSError as e:
+                    print(f"Error removing {entry.path}: {e}")
+                    continue
+                removed += 1
+                freed += stat.st_size
+        return removed, freed
+
+def ingest_image(source, images_dir, max_dimension=INGEST_MAX_DIMENSION, image_format=INGEST_FORMAT,
+                 quality=INGEST_QUALITY, keep_original=INGEST_KEEP_ORIGINAL):
+    """在进程池中处理插入的图片：按 EXIF 方向旋转，缩小到 max_dimension 以内并重新压缩
+
+    结果按原图内容和处理参数命名，同一张图片再次插入时只计算哈希。不需要旋转或缩小、
+    重新压缩后也没有变小的图片（以及动图）原样保存。返回处理报告。
+    """
+    start = time.perf_counter()
+    source_hash = ImageStore.file_hash(source)
+    source_ext = os.path.splitext(source)[1].lower()
+    ext = '.webp' if image_format == 'webp' else '.jpg'
+    converted_path = os.path.join(images_dir, f'{source_hash}_{max_dimension}q{quality}{ext}')
+    # 原样保存时与 ImageStore.add_file 的命名相同
+    original_path = os.path.join(images_dir, source_hash + source_ext)
+    report = {'original_bytes': os.path.getsize(source), 'cached': False, 'converted': False}
+
+    def finish(path):
+        report['path'] = path
+        report['stored_bytes'] = os.path.getsize(path)
+        report['seconds'] = time.perf_counter() - start
+        return report
+
+    if keep_original:
+        originals_dir = os.path.join(images_dir, 'originals')
+        os.makedirs(originals_dir, exist_ok=True)
+        kept_path = os.path.join(originals_dir, source_hash + source_ext)
+        if not os.path.exists(kept_path):
+            shutil.copyfile(source, kept_path)
+    for path in (converted_path, original_path):
+        if os.path.exists(path):
+            os.utime(path)
+            report['cached'] = True
+            return finish(path)
+
+    with Image.open(source) as image:
+        rotated = image.getexif().get(0x0112, 1) not in (0, 1)
+        too_large = max(image.size) > max_dimension
+        has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+        if getattr(image, 'is_animated', False) or (has_alpha and image_format != 'webp'):
+            converted = None
+        else:
+            converted = ImageOps.exif_transpose(image)
+            if too_large:
+                converted.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+            converted = converted.convert('RGBA' if has_alpha else 'RGB')
+        icc_profile = image.info.get('icc_profile')
+    if converted is not None:
+        temp_file = converted_path + '.tmp'
+        converted.save(temp_file, 'WEBP' if image_format == 'webp' else 'JPEG',
+                       quality=quality, icc_profile=icc_profile)
+        if rotated or too_large or os.path.getsize(temp_file) < report['original_bytes']:
+            os.replace(temp_file, converted_path)
+            report['converted'] = True
+            return finish(converted_path)
+        os.remove(temp_file)
+    temp_file = original_path + '.tmp'
+    shutil.copyfile(source, temp_file)
+    os.replace(temp_file, original_path)
+    return finish(original_path)
+
+class NoteHistory:
+    """便签的修订历史，保存在 history.db 中
+
+    每次保存正文记录一个修订。正文先经 ContentCodec 编码，修订按行比较：每隔
+    HISTORY_KEYFRAME_INTERVAL 个修订（或差异不比完整内容小时）保存完整内容作为关键帧，
+    其余保存相对上一个修订的 difflib 差异，因此重建任意修订最多应用
+    HISTORY_KEYFRAME_INTERVAL - 1 个差异。差异为 JSON 列表，[起, 止) 表示复制上一个修订的
+    这些行，字符串表示插入的文本。写入和读取都在同一个后台线程中按提交顺序执行。
+    """
+    KEYFRAME = 0
+    DELTA = 1
+    # 最近写入的便签的最后一个修订：便签ID -> (修订号, 距关键帧的修订数, 标题, 编码后的正文)
+    HEAD_CACHE_SIZE = 64
+
+    def __init__(self, data_dir):
+        self.db_file = os.path.join(data_dir, 'history.db')
+        self.conn = sqlite3.connect(self.db_file, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS revisions (
+                    note_id INTEGER NOT NULL,
+                    rev INTEGER NOT NULL,
+                    time REAL,
+                    title TEXT NOT NULL DEFAULT '',
+                    kind INTEGER NOT NULL,
+                    data NOT NULL,
+                    PRIMARY KEY (note_id, rev)
+                ) WITHOUT ROWID
+            """)
+        self.heads = OrderedDict()
+        # 连接只在这个线程中使用
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='NoteHistory')
+
+    @staticmethod
+    def pack(text):
+        if CONTENT_COMPRESS_BYTES is not None and len(text) >= CONTENT_COMPRESS_BYTES:
+            return zlib.compress(text.encode('utf-8'))
+        return text
+
+    @staticmethod
+    def unpack(value):
+        if isinstance(value, bytes):
+            return zlib.decompress(value).decode('utf-8')
+        return value
+
+    @staticmethod
+    def diff(old_lines, new_lines):
+        ops = []
+        matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'equal':
+                ops.append([i1, i2])
+            elif j1 < j2:
+                ops.append(''.join(new_lines[j1:j2]))
+        return ops
+
+    @staticmethod
+    def patch(old_lines, ops):
+        parts = []
+        for op in ops:
+            if isinstance(op, str):
+                parts.append(op)
+            else:
+                parts.extend(old_lines[op[0]:op[1]])
+        return ''.join(parts)
+
+    def record(self, note_id, title, content, previous=None):
+        # 记录一个修订，返回 Future；previous 为修改前的 (标题, 正文)，
+        # 便签还没有历史时先把它记为第一个修订
+        return self.executor.submit(self.write_revision, note_id, title, content,
+                                    datetime.now().timestamp(), previous)
+
+    def revisions(self, note_id):
+        # 返回便签的修订列表 [{'rev', 'time', 'title'}]，从旧到新；time 为 None 表示
+        # 有历史之前的内容
+        return self.executor.submit(self.list_revisions, note_id).result()
+
+    def revision(self, note_id, rev):
+        # 返回指定修订的 {'rev', 'time', 'title', 'content'}，不存在时返回 None
+        return self.executor.submit(self.read_revision, note_id, rev).result()
+
+    def purge(self, note_ids):
+        # 删除永久删除的便签的历史
+        return self.executor.submit(self.delete_notes, list(note_ids))
+
+    def thin(self, now=None):
+        # 按保留策略清理旧修订，返回结果为删除的修订数的 Future
+        return self.executor.submit(self.thin_all, now or datetime.now().timestamp())
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.conn.close()
+
+    # 以下方法在后台线程中执行
+
+    def list_revisions(self, note_id):
+        return [{'rev': rev, 'time': saved, 'title': title} for rev, saved, title in self.conn.execute(
+            'SELECT rev, time, title FROM revisions WHERE note_id = ? ORDER BY rev', (note_id,))]
+
+    def read_revision(self, note_id, rev):
+        # 从不晚于该修订的最后一个关键帧开始应用差异
+        rows = self.conn.execute(
+            'SELECT rev, time, title, kind, data FROM revisions WHERE note_id = ? AND rev <= ? AND '
+            'rev >= (SELECT MAX(rev) FROM revisions WHERE note_id = ? AND rev <= ? AND kind = ?) '
+            'ORDER BY rev', (note_id, rev, note_id, rev, self.KEYFRAME)).fetchall()
+        if not rows or rows[-1][0] != rev:
+            return None
+        text = self.apply(rows)
+        return {'rev': rev, 'time': rows[-1][1], 'title': rows[-1][2],
+                'content': ContentCodec.decode(text)}
+
+    def apply(self, rows, text=None):
+        # 依次应用 (rev, time, title, kind, data) 行，返回最后一个修订编码后的正文
+        for row in rows:
+            data = self.unpack(row[4])
+            if row[3] == self.KEYFRAME:
+                text = data
+            else:
+                text = self.patch(text.splitlines(keepends=True), json.loads(data))
+        return text
+
+    def head(self, note_id):
+        head = self.heads.get(note_id)
+        if head is not None:
+            self.heads.move_to_end(note_id)
+            return head
+        row = self.conn.execute('SELECT MAX(rev) FROM revisions WHERE note_id = ?',
+                                (note_id,)).fetchone()
+        if row[0] is None:
+            return None
+        rows = self.conn.execute(
+            'SELECT rev, time, title, kind, data FROM revisions WHERE note_id = ? AND '
+            'rev >= (SELECT MAX(rev) FROM revisions WHERE note_id = ? AND kind = ?) ORDER BY rev',
+            (note_id, note_id, self.KEYFRAME)).fetchall()
+        return self.cache_head(note_id, (rows[-1][0], len(rows) - 1, rows[-1][2], self.apply(rows)))
+
+    def cache_head(self, note_id, head):
+        self.heads[note_id] = head
+        self.heads.move_to_end(note_id)
+        if len(self.heads) > self.HEAD_CACHE_SIZE:
+            self.heads.popitem(last=False)
+        return head
+
+    def insert(self, note_id, rev, saved, title, text, base):
+        # 在当前事务中写入一个修订，base 为上一个修订的 head，返回新的 head
+        if base is not None and base[1] + 1 < HISTORY_KEYFRAME_INTERVAL:
+            delta = json.dumps(self.diff(base[3].splitlines(keepends=True),
+                                         text.splitlines(keepends=True)), ensure_ascii=False)
+            if len(delta) < len(text):
+                self.conn.execute('INSERT OR REPLACE INTO revisions VALUES (?, ?, ?, ?, ?, ?)',
+                                  (note_id, rev, saved, title, self.DELTA, self.pack(delta)))
+                return rev, base[1] + 1, title, text
+        self.conn.execute('INSERT OR REPLACE INTO revisions VALUES (?, ?, ?, ?, ?, ?)',
+                          (note_id, rev, saved, title, self.KEYFRAME, self.pack(text)))
+        return rev, 0, title, text
+
+    def write_revision(self, note_id, title, content, saved, previous):
+        try:
+            with self.conn:
+                head = self.head(note_id)
+                if head is None and previous is not None:
+                    head = self.insert(note_id, 0, None, previous[0],
+                                       ContentCodec.encode(previous[1]), None)
+                text = ContentCodec.encode(content)
+                if head is not None and head[2] == title and head[3] == text:
+                    # 内容没有变化
+                    return
+                rev = 0 if head is None else head[0] + 1
+                head = self.insert(note_id, rev, saved, title, text, head)
+            self.cache_head(note_id, head)
+        except Exception as e:
+            self.heads.pop(note_id, None)
+            print(f"Error saving note history {note_id}: {e}")
+
+    def delete_notes(self, note_ids):
+        with self.conn:
+            self.conn.executemany('DELETE FROM revisions WHERE note_id = ?',
+                                  [(note_id,) for note_id in note_ids])
+        for note_id in note_ids:
+            self.heads.pop(note_id, None)
+
+    @staticmethod
+    def retained(rows, now):
+        # rows 为按修订号排列的 [(修订号, 时间)]，返回保留的修订号；最后一个修订总是保留
+        day = 24 * 3600
+        keep = {rows[-1][0]}
+        buckets = {}
+        for rev, saved in rows:
+            saved = saved or 0
+            age = now - saved
+            if age < HISTORY_KEEP_ALL_DAYS * day:
+                keep.add(rev)
+            elif age < HISTORY_DAILY_DAYS * day:
+                buckets['day', int(saved // day)] = rev
+            else:
+                buckets['week', int(saved // (7 * day))] = rev
+        keep.update(buckets.values())
+        return keep
+
+    def thin_all(self, now):
+        cutoff = now - HISTORY_KEEP_ALL_DAYS * 24 * 3600
+        note_ids = [row[0] for row in self.conn.execute(
+            'SELECT DISTINCT note_id FROM revisions WHERE time IS NULL OR time < ?', (cutoff,))]
+        removed = 0
+        for note_id in note_ids:
+            try:
+                removed += self.thin_note(note_id, now)
+            except Exception as e:
+                print(f"Error thinning note history {note_id}: {e}")
+        return removed
+
+    def thin_note(self, note_id, now):
+        # 重建全部修订后只写回保留的修订，差异改为相对上一个保留的修订
+        rows = self.conn.execute(
+            'SELECT rev, time, title, kind, data FROM revisions WHERE note_id = ? ORDER BY rev',
+            (note_id,)).fetchall()
+        keep = self.retained([row[:2] for row in rows], now)
+        if len(keep) == len(rows):
+            return 0
+        self.heads.pop(note_id, None)
+        with self.conn:
+            self.conn.execute('DELETE FROM revisions WHERE note_id = ?', (note_id,))
+            text = None
+            head = None
+            for row in rows:
+                text = self.apply([row], text)
+                if row[0] in keep:
+                    head = self.insert(note_id, row[0], row[1], row[2], text, head)
+        return len(rows) - len(keep)
 
 class NoteData:
     """便签数据管理类"""
-    def __init__(self):
+    def __init__(self, backend=None):
         self.data_dir = os.path.join(os.path.expanduser('~'), 'NoteDesk')
-        self.data_file = os.path.join(self.data_dir, 'notes.json')
         self.images_dir = os.path.join(self.data_dir, 'images')  # 添加图片目录
         self.ensure_data_dir()
-        self.notes = self.load_notes()
+        self.images = ImageStore(self.images_dir)
+        self.storage = open_storage(self.data_dir, backend)
+        self.history = NoteHistory(self.data_dir)
+        # 便签元数据的列式存储；notes 按存储中的顺序排列
+        self.table = NoteTable()
+        self.notes = []
+        # 便签ID -> 便签，以及按显示顺序维护的索引
+        self.notes_by_id = self.table.by_id
+        self.order = NoteOrder(self.table)
+        # 缺少纯文本和预览字段的便签ID，空闲时补全
+        self.underived = []
+        # 标题和正文的全文索引；持久化的索引在界面显示后由 load_search_index 在后台线程中
+        # 读取，读取完成前搜索逐个扫描便签，新的修改暂时写入空的索引
+        self.search_index = NgramIndex()
+        self.search_index_file = os.path.join(self.data_dir, 'search_index.bin')
+        # 旧版本用 pickle 保存的索引不再读取，下次保存索引时删除
+        self.legacy_index_file = os.path.join(self.data_dir, 'search_index.pkl')
+        self.index_ready = not (SEARCH_INDEX_PERSIST and os.path.exists(self.search_index_file))
+        self.index_loader = None
+        # 索引读取完成前加载的便签 (便签ID, 文本校验值)，读取完成后从持久化的索引恢复
+        self.unrestored = []
+        # 索引读取完成前修改或删除过的便签ID，读取完成后在新索引中重做
+        self.index_touched = set()
+        # 结构化查询使用的颜色、创建时间和删除状态索引
+        self.attributes = AttributeIndex()
+        # 便签ID -> 便签中第一张图片的路径，用于卡片预览
+        self.cover_images = {}
+        # 便签只常驻元数据，正文按需读取，最近用过的保留在 LRU 中（可能在搜索线程中访问）
+        self.bodies = OrderedDict()
+        # 便签ID -> 修改正文时的提交序号，写入磁盘之前不从 LRU 中淘汰
+        self.unsaved_bodies = {}
+        self.body_lock = threading.RLock()
+        self.saver = BackgroundSaver(self.storage)
+        # 启动时只加载第一页，其余由界面在空闲时分批加载
+        self.pages = self.storage.load_pages(LOAD_PAGE_SIZE)
+        self.fully_loaded = False
+        # 便签ID -> 存储顺序，页面按显示顺序加载，全部加载后按它重排 self.notes
+        self.load_positions = {}
+        # 快照需要全部便签，尚未加载完时等最后一页加载后再写
+        self.compaction_pending = False
+        self.load_more()
         self.next_id = self.calculate_next_id()
+        if self.storage.needs_compaction():
+            self.request_compaction()
+
+    def calculate_next_id(self):
+        # 计算下一个可用的ID（包括尚未加载的便签）
+        return max(max(self.table.ids, default=-1), self.storage.max_id()) + 1
+
+    def ensure_data_dir(self):
+        if not os.path.exists(self.data_dir):
+            os.makedirs(self.data_dir)
+        if not os.path.exists(self.images_dir):  # 创建图片目录
+            os.makedirs(self.images_dir)
+
+    def load_more(self):
+        # 加载下一页，返回其中未删除便签的ID；全部加载完毕后返回 None
+        if self.fully_loaded:
+            return None
+        page = next(self.pages, None)
+        if page is None:
+            self.fully_loaded = True
+            self.pages = None
+            self.restore_order()
+            if self.compaction_pending:
+                self.compaction_pending = False
+                self.save_notes()
+            return None
+        active = []
+        active_ids = []
+        positions = self.load_positions
+        for fields in page:
+            position = fields.pop('position', None)
+            if position is not None:
+                positions[fields['id']] = position
+        # 分页期间已加载并被修改过的便签可能再次出现，跳过
+        notes_by_id = self.notes_by_id
+        page = [fields for fields in page if fields['id'] not in notes_by_id]
+        # 缺少的置顶和删除标志在列中默认为 False
+        notes = self.table.extend(page)
+        self.notes.extend(notes)
+        self.attributes.add_many(page)
+        # 以下从原始的 dict 读取字段，比 Note 快
+        for note, fields in zip(notes, page):
+            note_id = fields['id']
+            self.set_images(note_id, fields.get('images', []))
+            if not fields.get('is_deleted', False):
+                active.append(note)
+                active_ids.append(note_id)
+                # 持久化的索引中没有这个便签的当前文本时，空闲时读取正文建立索引
+                if not self.is_derived(fields):
+                    self.underived.append(note_id)
+                elif not self.index_ready:
+                    self.unrestored.append((note_id, fields['text_crc']))
+                elif not self.search_index.restore(note_id, fields['text_crc']):
+                    self.underived.append(note_id)
+        self.order.add_many(active)
+        return active_ids
+
+    def load_all(self):
+        while self.load_more() is not None:
+            pass
+
+    def restore_order(self):
+        # 页面按显示顺序到达，按存储顺序重排；没有存储顺序的（加载期间新建的）排在最后
+        positions = self.load_positions
+        if positions:
+            ids = self.table.ids
+            self.notes.sort(key=lambda note: positions.get(ids[note.row], math.inf))
+        self.load_positions = {}
+
+    @staticmethod
+    def is_derived(note):
+        return all(name in note for name in DERIVED_FIELDS)
+
+    def derive_fields(self, title, content, plain_text=None):
+        # 由正文生成纯文本、预览、引用的图片和全文索引校验值
+        if plain_text is None:
+            plain_text = html_to_text(content)
+        return {
+            'plain_text': plain_text,
+            'preview': make_preview(plain_text),
+            'images': self.images.image_names(content),
+            'text_crc': text_fingerprint(index_text(title, plain_text)),
+        }
+
+    def ensure_derived(self, note):
+        # 旧数据没有派生字段，或全文索引中没有这个便签时，读取正文补全并加入索引
+        note_id = note['id']
+        derived = self.is_derived(note)
+        if derived and (note.get('is_deleted', False) or note_id in self.search_index.texts):
+            return note
+        body = self.get_body(note_id)
+        plain_text = body.get('plain_text')
+        if not derived or plain_text is None:
+            fields = self.derive_fields(note['title'], body.get('content', ''), plain_text)
+            if plain_text is not None:
+                # 已保存的纯文本不必重写
+                del fields['plain_text']
+            plain_text = fields.get('plain_text', plain_text)
+            if 'images' not in note:
+                self.set_images(note_id, fields['images'])
+            self.update_fields(note, fields)
+        if not note.get('is_deleted', False):
+            self.index_note(note, plain_text)
+        return note
+
+    def get_body(self, note_id):
+        # 返回便签的正文字段（不要修改），不在 LRU 中时从存储读取
+        with self.body_lock:
+            body = self.bodies.get(note_id)
+            if body is None:
+                body = self.storage.load_body(note_id)
+                self.bodies[note_id] = body
+            else:
+                self.bodies.move_to_end(note_id)
+            self.trim_bodies()
+            return body
+
+    def note_content(self, note_id):
+        return self.get_body(note_id).get('content', '')
+
+    def note_text(self, note):
+        # 小写的 标题\n纯文本，未删除的便签直接取自全文索引
+        text = self.search_index.texts.get(note['id'])
+        if text is None:
+            text = index_text(note['title'], self.get_body(note['id']).get('plain_text', ''))
+        return text
+
+    def update_fields(self, note, fields, record=None):
+        # 元数据写入便签，正文字段写入 LRU，然后提交记录（默认为 set 记录）
+        note_id = note['id']
+        meta, body = split_body(fields)
+        note.update(meta)
+        with self.body_lock:
+            if body:
+                cached = self.bodies.get(note_id)
+                if cached is None and len(body) < len(BODY_FIELDS):
+                    cached = self.storage.load_body(note_id)
+                self.bodies[note_id] = dict(cached or {}, **body)
+                self.bodies.move_to_end(note_id)
+            if record is None:
+                record = {'op': 'set', 'id': note_id, 'fields': fields}
+            self.persist(record)
+            if body:
+                self.unsaved_bodies[note_id] = self.saver.submitted
+                self.trim_bodies()
+        return True
+
+    def trim_bodies(self):
+        # 淘汰最久未用的正文；尚未写入磁盘的正文只在 LRU 中，写入后才能淘汰
+        excess = len(self.bodies) - BODY_CACHE_SIZE
+        if excess <= 0:
+            return
+        written = self.saver.written
+        for note_id in list(self.bodies):
+            if excess <= 0:
+                break
+            if self.unsaved_bodies.get(note_id, 0) > written:
+                continue
+            self.unsaved_bodies.pop(note_id, None)
+            del self.bodies[note_id]
+            excess -= 1
+
+    def set_images(self, note_id, names):
+        if names:
+            self.cover_images[note_id] = os.path.join(self.images_dir, names[0])
+        else:
+            self.cover_images.pop(note_id, None)
+
+    def index_note(self, note, plain_text):
+        self.search_index.add(note['id'], index_text(note['title'], plain_text))
+        if not self.index_ready:
+            self.index_touched.add(note['id'])
+
+    def load_search_index(self, on_done=None):
+        # 在后台线程中读取持久化的全文索引，on_done() 在读取完成后于该线程中调用，
+        # 之后由界面线程调用 adopt_search_index 换上新索引
+        if self.index_ready or self.index_loader is not None:
+            return
+        loader = self.index_loader = Future()
+
+        def load():
+            index = NgramIndex()
+            index.load(self.search_index_file)
+            loader.set_result(index)
+            if on_done is not None:
+                on_done()
+
+        threading.Thread(target=load, name='SearchIndexLoader', daemon=True).start()
+
+    def adopt_search_index(self):
+        # 换上读取完成的索引：重做读取期间的修改，恢复此前加载的便签，持久化的索引中
+        # 没有当前文本的便签留待补全；返回索引是否已就绪
+        if self.index_ready:
+            return True
+        if self.index_loader is None or not self.index_loader.done():
+            return False
+        index = self.index_loader.result()
+        texts = self.search_index.texts
+        for note_id in self.index_touched:
+            text = texts.get(note_id)
+            if text is None:
+                index.remove(note_id)
+            else:
+                index.add(note_id, text)
+        for note_id, fingerprint in self.unrestored:
+            note = self.notes_by_id.get(note_id)
+            if (note_id in self.index_touched or note is None or
+                    note.get('is_deleted', False)):
+                continue
+            if not index.restore(note_id, fingerprint):
+                self.underived.append(note_id)
+        self.search_index = index
+        self.index_loader = None
+        self.unrestored = []
+        self.index_touched = set()
+        self.index_ready = True
+        return True
+
+    def backfill(self, limit=BACKFILL_CHUNK):
+        # 补全一批便签的纯文本字段并加入索引，返回本批便签的ID
+        batch = self.underived[-limit:]
+        del self.underived[-limit:]
+        for note_id in batch:
+            note = self.notes_by_id.get(note_id)
+            if note is not None:
+                self.ensure_derived(note)
+        return batch
 
-    def calculate_next_id(self):
-        # 计算下一个可用的ID
-        return max([note['id'] for note in self.notes], default=-1) + 1
+    def set_save_callbacks(self, on_saved=None, on_error=None):
+        # 回调在后台写入线程中调用
+        self.saver.on_saved = on_saved
+        self.saver.on_error = on_error
 
-    def ensure_data_dir(self):
-        if not os.path.exists(self.data_dir):
-            os.makedirs(self.data_dir)
-        if not os.path.exists(self.images_dir):  # 创建图片目录
-            os.makedirs(self.images_dir)
+    def persist(self, record):
+        # 修改已在内存中生效，写入由后台线程完成，结果通过回调通知
+        self.saver.submit(record)
+        if (not self.saver.snapshot_busy and not self.compaction_pending and
+                self.storage.needs_compaction()):
+            self.request_compaction()
+        return True
+
+    def request_compaction(self):
+        if self.fully_loaded:
+            self.save_notes()
+        else:
+            self.compaction_pending = True
+
+    def flush(self):
+        self.saver.flush()
 
-    def load_notes(self):
-        if os.path.exists(self.data_file):
+    def close(self):
+        # 退出前写入所有未保存的修改
+        self.saver.stop()
+        self.storage.close()
+        self.images.close()
+        self.history.close()
+        # 持久化的索引尚未读取完成时不必等待，保留原文件，其中过期的文本下次启动时按校验值跳过
+        self.adopt_search_index()
+        if SEARCH_INDEX_PERSIST and self.index_ready:
             try:
-                with open(self.data_file, 'r', encoding='utf-8') as f:
-                    notes = json.load(f)
-                    # 确保每个便签都有必要的字段
-                    for note in notes:
-                        if 'is_deleted' not in note:
-                            note['is_deleted'] = False
-                        if 'is_pinned' not in note:
-                            note['is_pinned'] = False
-                    return notes
+                if self.fully_loaded and self.search_index.needs_rebuild():
+                    self.search_index.rebuild()
+                self.search_index.save(self.search_index_file)
+                if os.path.exists(self.legacy_index_file):
+                    os.remove(self.legacy_index_file)
             except Exception as e:
-                print(f"Error loading notes: {e}")
-                return []
-        return []
+                print(f"Error saving search index: {e}")
 
     def get_active_notes(self):
-        return [note for note in self.notes if not note.get('is_deleted', False)]
+        # 按加载顺序排列
+        return self.table.active_notes()
+
+    def get_note(self, note_id):
+        # 返回未删除的便签，不存在时返回 None
+        note = self.notes_by_id.get(note_id)
+        if note is None or note.get('is_deleted', False):
+            return None
+        return note
 
     def save_notes(self):
-        try:
-            with open(self.data_file, 'w', encoding='utf-8') as f:
-                json.dump(self.notes, f, ensure_ascii=False, indent=2)
-            return True
-        except Exception as e:
-            print(f"Error saving notes: {e}")
-            return False
+        # 在后台线程写出完整快照（JSON 后端同时清空变更日志）；快照丢弃尚未写入的记录，
+        # 因此 LRU 中的正文（包括尚未写入的修改）一并写出。界面线程只复制便签列表和 LRU，
+        # 快照的 dict 在写入线程中由列生成；其间的修改作为记录在快照之后写入
+        self.load_all()
+        notes = list(self.notes)
+        table = self.table
+        with self.body_lock:
+            bodies = dict(self.bodies)
+
+        def build():
+            rows = table.rows(notes)
+            for fields in rows:
+                body = bodies.get(fields['id'])
+                if body:
+                    fields.update(body)
+            return rows
+
+        self.saver.submit_snapshot(build)
 
     def add_note(self, title, content, timestamp):
-        note = {
+        fields = {
             'id': self.next_id,
             'title': title,
-            'content': content,
             'timestamp': timestamp,
             'is_pinned': False,
             'is_deleted': False,
             'create_time': datetime.now().timestamp()
         }
+        derived = self.derive_fields(title, content)
+        derived['content'] = content
+        meta, body = split_body(derived)
+        fields.update(meta)
+        note = self.table.append(fields)
         self.notes.append(note)
+        self.order.add(note)
+        self.attributes.add(note)
+        self.set_images(note['id'], derived['images'])
+        self.index_note(note, derived['plain_text'])
         self.next_id += 1
-        self.save_notes()
+        self.update_fields(note, body, {'op': 'add', 'note': dict(note, **body)})
+        self.history.record(note['id'], title, content)
         return note
 
     def update_note(self, note_id, title, content):
-        for note in self.notes:
-            if note['id'] == note_id and not note.get('is_deleted', False):
-                note['title'] = title
-                note['content'] = content
-                note['timestamp'] = datetime.now().strftime("%H:%M")
-                return self.save_notes()
-        return False
+        note = self.get_note(note_id)
+        if note is None:
+            return False
+        fields = {
+            'title': title,
+            'content': content,
+            'timestamp': datetime.now().strftime("%H:%M")
+        }
+        fields.update(self.derive_fields(title, content))
+        # 便签还没有历史时，修改前的内容记为第一个修订
+        previous = (note['title'], self.note_content(note_id))
+        self.set_images(note_id, fields['images'])
+        self.update_fields(note, fields)
+        self.index_note(note, fields['plain_text'])
+        self.history.record(note_id, title, content, previous)
+        return True
 
-    def search_notes(self, query):
-        query = query.lower()
-        return [note for note in self.notes 
-                if not note.get('is_deleted', False) and
-                (query in note['title'].lower() or 
-                 query in note['content'].lower())]
+    def note_revisions(self, note_id):
+        return self.history.revisions(note_id)
+
+    def note_revision(self, note_id, rev):
+        return self.history.revision(note_id, rev)
+
+    def search_ids(self, query, is_cancelled=None):
+        # 只查索引，可在后台线程中调用；调用前应先在主线程中 backfill
+        return self.query_ids(NoteQuery(query), is_cancelled)
+
+    def rank_ids(self, query, limit=SEARCH_RANK_LIMIT, is_cancelled=None):
+        # 按相关度排序的搜索：字段子句只用于缩小范围，全文查询词参与打分
+        query = NoteQuery(query)
+        terms = query.terms()
+        # 持久化的全文索引读取完成前无法打分，逐个扫描便签后与没有查询词时一样排列
+        scan = bool(terms) and not self.index_ready
+        filters = query if scan else query.filters()
+        candidates = None
+        if not filters.is_empty():
+            candidates = self.query_ids(filters, is_cancelled)
+            if candidates is None:
+                return None
+        if terms and not scan:
+            return self.search_index.rank(' '.join(terms), limit, is_cancelled, candidates)
+        if not candidates:
+            return []
+        # 没有全文查询词时按创建时间排列，新的在前
+        notes_by_id = self.notes_by_id
+        return heapq.nlargest(limit, candidates,
+                              key=lambda note_id: notes_by_id[note_id].get('create_time') or 0)
+
+    def lookup_cost(self, query, field, value):
+        # 估算子句在索引中的候选数量，无法用索引查找时返回 None
+        if field == 'id':
+            return 1
+        if field == 'pinned':
+            # 置顶索引只包含未删除的便签
+            if query.deleted:
+                return None
+            return len(self.order.pinned_ids if value else self.order.unpinned_ids)
+        if field == 'color':
+            return len(self.attributes.colors.get(value, ()))
+        if field == 'created':
+            start, end = self.attributes.created_range(*value)
+            return end - start
+        if field in (None, 'title') and not query.deleted and self.index_ready:
+            # 全文索引不包含已删除的便签，读取完成前不使用
+            return self.search_index.estimate(value)
+        return None
+
+    def lookup(self, field, value, is_cancelled=None):
+        # 从索引中取出子句的候选便签ID集合
+        if field == 'id':
+            return {value} if value in self.notes_by_id else set()
+        if field == 'pinned':
+            return set(self.order.pinned_ids if value else self.order.unpinned_ids)
+        if field == 'color':
+            return set(self.attributes.colors.get(value, ()))
+        if field == 'created':
+            start, end = self.attributes.created_range(*value)
+            return set(self.attributes.created_ids[start:end])
+        return self.search_index.search(value, is_cancelled)
+
+    def query_ids(self, query, is_cancelled=None):
+        # 按估算的候选数量从小到大查索引并求交，候选足够少后其余子句逐个校验，
+        # 不扫描全部便签；只使用已建立索引的文本，可在后台线程中调用
+        plan = []
+        for clause in query.clauses:
+            negated, field, value = clause
+            cost = None if negated else self.lookup_cost(query, field, value)
+            if cost is not None:
+                plan.append((cost, clause))
+        plan.sort(key=lambda step: step[0])
+        remaining = list(query.clauses)
+        if plan:
+            candidates = None
+            for cost, clause in plan:
+                if candidates is not None and len(candidates) < 64:
+                    break
+                found = self.lookup(clause[1], clause[2], is_cancelled)
+                if found is None:
+                    return None
+                candidates = found if candidates is None else candidates & found
+                if clause[1] != 'title':
+                    # 标题子句的候选来自全文索引，还需要校验
+                    remaining.remove(clause)
+        elif query.deleted:
+            candidates = set(self.table.deleted_ids())
+        else:
+            candidates = set(self.order.ids())
+        needs_text = any(field in (None, 'title') for _, field, _ in remaining)
+        notes_by_id = self.notes_by_id
+        texts = self.search_index.texts
+        flags = self.table.flags
+        deleted = NoteTable.DELETED if query.deleted else 0
+        results = set()
+        for count, note_id in enumerate(candidates):
+            if is_cancelled is not None and count % 4096 == 0 and is_cancelled():
+                return None
+            note = notes_by_id.get(note_id)
+            if note is None or flags[note.row] & NoteTable.DELETED != deleted:
+                continue
+            text = ''
+            if needs_text:
+                text = texts.get(note_id)
+                if text is None:
+                    if not self.is_derived(note):
+                        continue
+                    text = self.note_text(note)
+            if all(NoteQuery.clause_matches(field, value, note, text) != negated
+                   for negated, field, value in remaining):
+                results.add(note_id)
+        return results
+
+    def search_notes(self, query, note_ids=None):
+        # note_ids 不为空时只在这些便签中搜索（用于启动时新加载的便签）
+        query = NoteQuery(query)
+        if note_ids is None:
+            # 尚未生成纯文本的旧便签先补全并加入索引，再查索引
+            self.backfill(len(self.underived))
+            note_ids = self.query_ids(query)
+        notes = (self.notes_by_id[note_id] for note_id in note_ids)
+        return [note for note in notes
+                if query.matches(note, self.note_text(self.ensure_derived(note)))]
 
     def delete_note(self, note_id):
+        note = self.notes_by_id.get(note_id)
+        if note is None:
+            return False
+        fields = {'is_deleted': True, 'delete_time': datetime.now().timestamp()}
+        note.update(fields)
+        self.order.remove(note_id)
+        self.search_index.remove(note_id)
+        if not self.index_ready:
+            self.index_touched.add(note_id)
+        return self.persist({'op': 'set', 'id': note_id, 'fields': fields})
+
+    def collect_garbage(self, retention_days=GC_RETENTION_DAYS, thumbs_dir=None, on_done=None):
+        # 永久删除超过保留期的已删除便签并重写存储，然后在后台线程中清理不再被引用的图片；
+        # on_done(report) 在后台线程中调用
+        start = time.perf_counter()
+        self.load_all()
+        now = datetime.now().timestamp()
+        cutoff = now - retention_days * 24 * 3600
+        expired = []
         for note in self.notes:
-            if note['id'] == note_id:
-                note['is_deleted'] = True
-                return self.save_notes()
-        return False
+            if not note.get('is_deleted', False):
+                continue
+            if note.get('delete_time') is None:
+                # 旧版本删除的便签没有删除时间，从现在开始计算保留期
+                note['delete_time'] = now
+                self.persist({'op': 'set', 'id': note['id'], 'fields': {'delete_time': now}})
+            elif note['delete_time'] < cutoff:
+                expired.append(note)
+        if expired:
+            expired_ids = {note['id'] for note in expired}
+            with self.body_lock:
+                for note in expired:
+                    self.attributes.remove(note)
+                    self.table.remove(note)
+                    self.cover_images.pop(note['id'], None)
+                    self.bodies.pop(note['id'], None)
+                    self.unsaved_bodies.pop(note['id'], None)
+            self.notes = [note for note in self.notes if note['id'] not in expired_ids]
+            self.save_notes()
+            self.history.purge(expired_ids)
+        # 修订历史按保留策略清理，在历史的后台线程中进行
+        thinned = self.history.thin()
+        # 图片列表在保存便签时从内容中解析，缺少时（旧数据）读取正文解析
+        marked = set()
+        for note in self.notes:
+            names = note.get('images')
+            if names is None:
+                names = self.images.image_names(self.note_content(note['id']))
+            marked.update(names)
+        purge_seconds = time.perf_counter() - start
+
+        def sweep():
+            sweep_start = time.perf_counter()
+            # 被清除的便签已不在任何索引中，可以在后台线程中读取
+            note_bytes = sum(len(json.dumps(dict(note), ensure_ascii=False).encode('utf-8'))
+                             for note in expired)
+            removed, freed = self.images.sweep(marked, thumbs_dir)
+            report = {
+                'purged_notes': len(expired), 'note_bytes': note_bytes,
+                'removed_files': removed, 'freed_bytes': freed,
+                'thinned_revisions': thinned.result(),
+                'seconds': purge_seconds + time.perf_counter() - sweep_start,
+            }
+            if on_done is not None:
+                on_done(report)
+
+        thread = threading.Thread(target=sweep, name='NoteGarbageCollector', daemon=True)
+        thread.start()
+        return thread
 
     def update_note_pin_status(self, note_id, is_pinned):
-        for note in self.notes:
-            if note['id'] == note_id and not note.get('is_deleted', False):
-                note['is_pinned'] = is_pinned
-                note['pin_time'] = datetime.now().timestamp() if is_pinned else None
-                return self.save_notes()
-        return False
+        note = self.get_note(note_id)
+        if note is None:
+            return False
+        fields = {
+            'is_pinned': is_pinned,
+            'pin_time': datetime.now().timestamp() if is_pinned else None
+        }
+        # 先按旧的排序键移出，更新后再插入
+        self.order.remove(note_id)
+        note.update(fields)
+        self.order.add(note)
+        return self.persist({'op': 'set', 'id': note_id, 'fields': fields})
 
     def get_notes_ordered(self):
-        # 获取未删除的便签
-        active_notes = [note for note in self.notes if not note.get('is_deleted', False)]
-        
-        # 分离置顶和非置顶便签
-        pinned_notes = [note for note in active_notes if note.get('is_pinned', False)]
-        unpinned_notes = [note for note in active_notes if not note.get('is_pinned', False)]
-        
-        # 置顶便签按置顶时间排序（新的在最前面）
-        pinned_notes.sort(key=lambda x: x.get('pin_time', 0), reverse=True)
-        # 非置顶便签按创建时间排序（新的在最前面）
-        unpinned_notes.sort(key=lambda x: x.get('create_time', 0), reverse=True)
-        
-        # 返回排序后的便签列表（置顶的在最前）
-        return pinned_notes + unpinned_notes
+        # 置顶便签按置顶时间、非置顶便签按创建时间排列（新的在最前面）
+        return list(map(self.notes_by_id.__getitem__, self.order.id_list()))
 
     def reorder_notes(self, source_id, target_id):
-        # 只处理未删除的便签
-        active_notes = [note for note in self.notes if not note.get('is_deleted', False)]
-        source_note = None
-        source_index = -1
-        target_index = -1
-        
-        for i, note in enumerate(active_notes):
-            if note['id'] == source_id:
-                source_note = note
-                source_index = i
-            elif note['id'] == target_id:
-                target_index = i
-                
-        if source_note and source_index != -1 and target_index != -1:
+        # 排序记录包含全部便签ID，需要先加载完
+        self.load_all()
+        # 只处理未删除的便签，删除标志直接从列中读取
+        flags = self.table.flags
+        deleted_notes = []
+        active_notes = []
+        for note in self.notes:
+            if flags[note.row] & NoteTable.DELETED:
+                deleted_notes.append(note)
+            else:
+                active_notes.append(note)
+        source_note = self.get_note(source_id)
+        target_note = self.get_note(target_id)
+        if source_note is not None and target_note is not None and source_note is not target_note:
+            source_index = active_notes.index(source_note)
+            target_index = active_notes.index(target_note)
             active_notes.pop(source_index)
             active_notes.insert(target_index, source_note)
             # 更新主列表中的顺序
-            self.notes = [note for note in self.notes if note.get('is_deleted', False)] + active_notes
-            self.save_notes()
+            self.notes = deleted_notes + active_notes
+            ids = self.table.ids
+            self.persist({'op': 'order', 'ids': [ids[note.row] for note in self.notes]})
 
     def update_note_color(self, note_id, color):
-        try:
-            for note in self.notes:
-                if note['id'] == note_id and not note.get('is_deleted', False):
-                    note['background_color'] = color
-                    with open(self.data_file, 'w', encoding='utf-8') as f:
-                        json.dump(self.notes, f, ensure_ascii=False, indent=2)
-                    print(f"Successfully saved color {color} for note {note_id}")
-                    return True
-            return False
-        except Exception as e:
-            print(f"Error saving note color: {e}")
+        note = self.get_note(note_id)
+        if note is None:
             return False
+        note['background_color'] = color
+        self.attributes.set_color(note_id, color)
+        return self.persist({'op': 'set', 'id': note_id, 'fields': {'background_color': color}})
+
+class ImageLoadTask(QRunnable):
+    """在线程池中解码一张图片，结果通过缓存的信号交回界面线程"""
+    def __init__(self, cache, key, path, width, height):
+        super().__init__()
+        self.cache = cache
+        self.key = key
+        self.path = path
+        self.width = width
+        self.height = height
+
+    def run(self):
+        image = self.cache.load(self.path, self.width, self.height)
+        self.cache.loaded.emit(self.key, self.path, image)
+
+class ThumbnailCache(QObject):
+    """图片缩略图缓存
+
+    图片存储中的原图按内容哈希命名，缩小后的图片按原图文件名和尺寸保存在磁盘上；
+    存储以外的图片（旧便签引用的外部文件）同名时内容可能不同，不保存到磁盘。
+    解码后的 QImage 按原图完整路径和尺寸保存在按字节数限制大小的 LRU 中。
+    原图不超过请求的尺寸时直接读取原图，不另存副本。
+    读取和解码在线程池中进行，完成后发出 image_ready，读取失败时发出 image_failed；
+    LRU 只在界面线程中访问。
+    """
+    loaded = pyqtSignal(object, str, QImage)  # 键, 原图路径, 图片（由线程池发出）
+    image_ready = pyqtSignal(str, int, int)  # 原图路径, 宽, 高
+    image_failed = pyqtSignal(str, int, int)  # 原图路径, 宽, 高（文件不存在或无法解码）
+
+    def __init__(self, thumbs_dir, images_dir, max_bytes=THUMB_CACHE_BYTES, parent=None):
+        super().__init__(parent)
+        self.thumbs_dir = thumbs_dir
+        self.images_dir = os.path.normpath(images_dir)
+        if not os.path.exists(thumbs_dir):
+            os.makedirs(thumbs_dir)
+        self.max_bytes = max_bytes
+        # (原图路径, 宽, 高) -> QImage，最近使用的在末尾
+        self.images = OrderedDict()
+        self.total_bytes = 0
+        # 正在加载的键，避免重复提交
+        self.pending = set()
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(IMAGE_LOAD_THREADS)
+        self.loaded.connect(self.store)
+
+    def thumb_path(self, path, width, height):
+        # 只有图片存储中按内容哈希命名的原图有磁盘缩略图，其他图片返回 None
+        directory, name = os.path.split(os.path.normpath(path))
+        if directory != self.images_dir:
+            return None
+        name, ext = os.path.splitext(name)
+        ext = '.jpg' if ext.lower() in ('.jpg', '.jpeg') else '.png'
+        return os.path.join(self.thumbs_dir, f'{name}_{width}x{height}{ext}')
+
+    def request(self, path, width, height):
+        # 返回缩放到 width x height 以内的图片；不在内存中时提交后台加载并返回 None，
+        # 加载完成后发出 image_ready，读取失败时发出 image_failed
+        key = (os.path.normpath(path), width, height)
+        image = self.images.get(key)
+        if image is not None:
+            self.images.move_to_end(key)
+            return image
+        if key not in self.pending:
+            self.pending.add(key)
+            self.pool.start(ImageLoadTask(self, key, path, width, height))
+        return None
+
+    def store(self, key, path, image):
+        self.pending.discard(key)
+        if image.isNull():
+            self.image_failed.emit(path, key[1], key[2])
+            return
+        self.images[key] = image
+        self.total_bytes += image.sizeInBytes()
+        while self.total_bytes > self.max_bytes and len(self.images) > 1:
+            _, old = self.images.popitem(last=False)
+            self.total_bytes -= old.sizeInBytes()
+        self.image_ready.emit(path, key[1], key[2])
+
+    def stop(self):
+        self.pool.clear()
+        self.pool.waitForDone()
+
+    def load(self, path, width, height):
+        # 在线程池中调用，只使用 QImage，不使用 QPixmap
+        thumb_path = self.thumb_path(path, width, height)
+        if thumb_path is not None and os.path.exists(thumb_path):
+            image = QImage(thumb_path)
+            if not image.isNull():
+                return image
+        reader = QImageReader(path)
+        size = reader.size()
+        if not size.isValid() or (size.width() <= width and size.height() <= height):
+            return reader.read()
+        # 解码时直接缩小，JPEG 等格式不需要先解码出完整的原图
+        reader.setScaledSize(size.scaled(width, height, Qt.KeepAspectRatio))
+        image = reader.read()
+        if thumb_path is not None and not image.isNull():
+            temp_file = thumb_path + '.tmp'
+            if image.save(temp_file, 'JPG' if thumb_path.endswith('.jpg') else 'PNG', 90):
+                os.replace(temp_file, thumb_path)
+        return image
+
+class NoteTextEdit(QTextEdit):
+    """按需加载图片的编辑器
+
+    文档第一次用到图片目录中的图片时（布局或绘制时）调用 loadResource：缓存中已有
+    缩略图就直接返回，否则先返回占位图并提交后台加载，加载完成后替换为缩略图。
+    """
+    PLACEHOLDER = None
+
+    def __init__(self, thumbnails, images_dir, parent=None):
+        super().__init__(parent)
+        self.thumbnails = thumbnails
+        self.images_dir = images_dir
+        # 图片路径 -> 文档请求时使用的 QUrl，缩略图加载完成后用它注册资源
+        self.loading_images = {}
+        thumbnails.image_ready.connect(self.on_image_ready)
+        thumbnails.image_failed.connect(self.on_image_failed)
+        # 多张图片陆续加载完成时合并为一次重新布局
+        self.relayout_timer = QTimer(self)
+        self.relayout_timer.setSingleShot(True)
+        self.relayout_timer.setInterval(50)
+        self.relayout_timer.timeout.connect(self.relayout)
+
+    @classmethod
+    def placeholder(cls):
+        # 所有编辑器共用一张占位图，有宽高属性的图片绘制时按属性拉伸
+        if cls.PLACEHOLDER is None:
+            cls.PLACEHOLDER = QImage(EDITOR_IMAGE_SIZE, EDITOR_IMAGE_SIZE * 3 // 4, QImage.Format_RGB32)
+            cls.PLACEHOLDER.fill(QColor('#eeeeee'))
+        return cls.PLACEHOLDER
+
+    def loadResource(self, resource_type, url):
+        if resource_type != QTextDocument.ImageResource:
+            return super().loadResource(resource_type, url)
+        path = url.toLocalFile() if url.isLocalFile() else url.toString()
+        if os.path.dirname(os.path.normpath(path)) != self.images_dir:
+            return super().loadResource(resource_type, url)
+        image = self.thumbnails.request(path, EDITOR_IMAGE_SIZE, EDITOR_IMAGE_SIZE)
+        if image is not None:
+            return image
+        self.loading_images[path] = url
+        return self.placeholder()
+
+    def on_image_ready(self, path, width, height):
+        url = self.loading_images.get(path)
+        if url is None or (width, height) != (EDITOR_IMAGE_SIZE, EDITOR_IMAGE_SIZE):
+            return
+        image = self.thumbnails.request(path, width, height)
+        if image is not None:
+            del self.loading_images[path]
+            self.document().addResource(QTextDocument.ImageResource, url, image)
+            self.relayout_timer.start()
+
+    def on_image_failed(self, path, width, height):
+        # 无法读取的图片保留占位图
+        if (width, height) == (EDITOR_IMAGE_SIZE, EDITOR_IMAGE_SIZE):
+            self.loading_images.pop(path, None)
+
+    def relayout(self):
+        document = self.document()
+        document.markContentsDirty(0, document.characterCount())
 
 class NoteEditDialog(QDialog):
+    image_ingested = pyqtSignal(object)  # 处理完成的图片 Future（由进程池的回调线程发出）
+
     def __init__(self, title, content, parent=None):
         super().__init__(parent)
         # 设置最小尺寸
@@ -234,7 +3783,8 @@ class NoteEditDialog(QDialog):
         content_layout.addWidget(self.title_edit)
         
         # 文本编辑区
-        self.editor = QTextEdit()
+        # 图片由编辑器按需在后台加载，打开便签时不解码任何图片
+        self.editor = NoteTextEdit(parent.thumbnails, parent.note_data.images_dir)
         self.editor.setHtml(content)
         self.editor.setStyleSheet("""
             QTextEdit {
@@ -246,6 +3796,11 @@ class NoteEditDialog(QDialog):
         """)
         # 存储图片路径映射
         self.image_paths = {}
+        # 正在处理的插入图片：Future -> 插入位置
+        self.pending_images = {}
+        # 点击保存时还有图片在处理，处理完成后再关闭对话框
+        self.accept_pending = False
+        self.image_ingested.connect(self.on_image_ingested)
         # 连接双击事件
         self.editor.mouseDoubleClickEvent = self.handle_double_click
         content_layout.addWidget(self.editor)
@@ -317,6 +3872,11 @@ class NoteEditDialog(QDialog):
         toolbar.addWidget(image_btn)  # 添加图片按钮到工具栏
         toolbar.addWidget(save_btn)
         
+        # 插入图片的处理结果
+        self.image_status = QLabel()
+        self.image_status.setStyleSheet("color: gray; font-size: 11px; padding: 0 5px;")
+        toolbar.addWidget(self.image_status)
+        
         content_layout.addWidget(toolbar)
         
         # 将内容布局添加到主布局
@@ -331,42 +3891,65 @@ class NoteEditDialog(QDialog):
             self, "选择图片", "", "图片文件 (*.png *.jpg *.jpeg *.gif *.bmp)"
         )
         if file_name:
-            # 生成唯一的图片文件名
-            image_name = f"image_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}{os.path.splitext(file_name)[1]}"
-            # 构建目标路径
-            target_path = os.path.join(self.parent().note_data.images_dir, image_name)
+            # 图片在进程池中旋转、缩小和重新压缩，完成后插入到选择图片时的位置
+            future = self.parent().note_data.images.ingest(file_name)
+            self.pending_images[future] = QTextCursor(self.editor.textCursor())
+            self.image_status.setText("正在处理图片...")
+            future.add_done_callback(self.image_ingested.emit)
+
+    def on_image_ingested(self, future):
+        cursor = self.pending_images.pop(future, None)
+        if cursor is None:
+            # 对话框已关闭
+            return
+        if not self.pending_images:
+            self.image_status.clear()
+        try:
+            report = future.result()
+            target_path = report['path']
             
-            try:
-                # 复制图片到应用数据目录
-                pixmap = QPixmap(file_name)
-                pixmap.save(target_path)
-                
-                # 创建缩略图
-                scaled_pixmap = pixmap.scaled(200, 200, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-                
-                # 将图片插入到文本编辑器中
-                cursor = self.editor.textCursor()
-                cursor.insertHtml(f'<div style="text-align: center;">')
-                
-                # 创建图片格式
-                image_format = QTextImageFormat()
-                image_format.setName(target_path)  # 使用新的路径
-                image_format.setWidth(scaled_pixmap.width())
-                image_format.setHeight(scaled_pixmap.height())
-                
-                # 将图片资源添加到文档
-                self.editor.document().addResource(
-                    QTextDocument.ImageResource,
-                    QUrl(f"file://{target_path}"),
-                    scaled_pixmap.toImage()
-                )
-                
-                # 插入图片
-                cursor.insertImage(image_format)
-                cursor.insertHtml('</div><br>')
-                
-            except Exception as e:
-                QMessageBox.warning(self, "错误", f"保存图片时出错：{str(e)}")
+            # 只读取文件头中的尺寸，缩略图在后台解码
+            size = QImageReader(target_path).size()
+            if not size.isValid():
+                raise ValueError("无法读取图片")
+            size = size.scaled(EDITOR_IMAGE_SIZE, EDITOR_IMAGE_SIZE, Qt.KeepAspectRatio)
+            
+            # 将图片插入到文本编辑器中
+            cursor.insertHtml(f'<div style="text-align: center;">')
+            
+            # 创建图片格式
+            image_format = QTextImageFormat()
+            image_format.setName(target_path)  # 使用新的路径
+            image_format.setWidth(size.width())
+            image_format.setHeight(size.height())
+            
+            # 插入图片
+            cursor.insertImage(image_format)
+            cursor.insertHtml('</div><br>')
+            
+            saved = report['original_bytes'] - report['stored_bytes']
+            self.image_status.setText(
+                f"{format_bytes(report['original_bytes'])} → {format_bytes(report['stored_bytes'])}，"
+                f"节省 {format_bytes(max(saved, 0))}，用时 {report['seconds']:.2f} 秒")
+        except Exception as e:
+            QMessageBox.warning(self, "错误", f"保存图片时出错：{str(e)}")
+        if self.accept_pending and not self.pending_images:
+            self.accept()
+
+    def accept(self):
+        # 还有图片在处理时不阻塞界面等待，全部插入后由 on_image_ingested 再次调用
+        if self.pending_images:
+            self.accept_pending = True
+            self.image_status.setText("正在处理图片，完成后保存...")
+            return
+        self.accept_pending = False
+        super().accept()
+
+    def reject(self):
+        # 放弃编辑时丢弃还在处理的图片，处理结果由图片清理删除
+        self.pending_images.clear()
+        self.accept_pending = False
+        super().reject()
 
     def handle_double_click(self, event):
         cursor = self.editor.cursorForPosition(event.pos())
@@ -379,7 +3962,7 @@ class NoteEditDialog(QDialog):
             # 检查图片路径是否存在
             if os.path.exists(image_path):
                 # 创建图片查看器窗口
-                viewer = ImageViewer(image_path)
+                viewer = ImageViewer(image_path, self.parent().thumbnails)
                 viewer.exec_()
             else:
                 QMessageBox.warning(self, "错误", "找不到图片文件，可能已被删除或移动")
@@ -498,119 +4081,382 @@ class NoteEditDialog(QDialog):
     def get_title(self):
         return self.title_edit.text()
 
-class NoteCard(QFrame):
-    note_clicked = pyqtSignal(int, str, str)  # id, title, content
-    note_deleted = pyqtSignal(int)  # 添加删除信号
-    note_pinned = pyqtSignal(int, bool)  # 添加置顶信号
+def longest_increasing_subsequence(values):
+    # 返回最长递增子序列在 values 中的下标，O(n log n)
+    tails = []      # tails[k]：长度为 k+1 的递增子序列的末尾下标
+    previous = [-1] * len(values)
+    tail_values = []
+    for i, value in enumerate(values):
+        k = bisect.bisect_left(tail_values, value)
+        if k > 0:
+            previous[i] = tails[k - 1]
+        if k == len(tails):
+            tails.append(i)
+            tail_values.append(value)
+        else:
+            tails[k] = i
+            tail_values[k] = value
+    result = []
+    i = tails[-1] if tails else -1
+    while i != -1:
+        result.append(i)
+        i = previous[i]
+    result.reverse()
+    return result
+
+class NoteListModel(QAbstractListModel):
+    """便签列表模型，按显示顺序提供便签数据，只有可见行才会被绘制"""
+    NoteIdRole = Qt.UserRole + 1
+    NoteRole = Qt.UserRole + 2
+    PreviewRole = Qt.UserRole + 3
+    ImageRole = Qt.UserRole + 4
 
-    def __init__(self, note_id, title, content, timestamp, parent=None):
+    def __init__(self, note_data, parent=None):
         super().__init__(parent)
-        self.note_id = note_id
-        self.title = title
-        self.content = content
-        self.is_pinned = False
-        self.setFrameStyle(QFrame.StyledPanel | QFrame.Raised)
-        self.setContextMenuPolicy(Qt.CustomContextMenu)
-        self.customContextMenuRequested.connect(self.show_context_menu)
-        
-        self.setCursor(Qt.ArrowCursor)
-        
-        layout = QVBoxLayout()
-        layout.setSpacing(5)
-        layout.setContentsMargins(10, 10, 10, 10)
-        
-        # 顶部布局（包含置顶图标、标题和时间）
-        top_layout = QHBoxLayout()
-        
+        self.note_data = note_data
+        # 当前显示的便签ID（显示顺序），搜索时只包含匹配的便签
+        self.ids = []
+        # 搜索结果ID集合，None 表示不过滤
+        self.filter_ids = None
+        # 按相关度排序的搜索结果，不为 None 时按此顺序显示而不是显示顺序
+        self.ranked_ids = None
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.ids)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.ids):
+            return None
+        note_id = self.ids[index.row()]
+        note = self.note_data.notes_by_id.get(note_id)
+        if note is None:
+            return None
+        if role == Qt.DisplayRole:
+            return note['title']
+        if role == self.NoteIdRole:
+            return note_id
+        if role == self.NoteRole:
+            return note
+        if role == self.PreviewRole:
+            return self.note_data.ensure_derived(note)['preview']
+        if role == self.ImageRole:
+            return self.note_data.cover_images.get(note_id)
+        return None
+
+    def matches(self, note_id):
+        return self.filter_ids is None or note_id in self.filter_ids
+
+    def row_of(self, note_id):
+        try:
+            return self.ids.index(note_id)
+        except ValueError:
+            return -1
+
+    def visible_ids(self):
+        order = self.note_data.order
+        if self.ranked_ids is not None:
+            # 相关度顺序不随置顶和拖动变化，只去掉已删除的便签
+            return [note_id for note_id in self.ranked_ids if note_id in order]
+        ids = order.id_list()
+        if self.filter_ids is not None:
+            filter_ids = self.filter_ids
+            ids = [note_id for note_id in ids if note_id in filter_ids]
+        return ids
+
+    def reload(self):
+        # 按数据的当前顺序一次性重建整个列表
+        ids = self.visible_ids()
+        self.beginResetModel()
+        self.ids = ids
+        self.endResetModel()
+
+    def sync(self):
+        # 与数据的当前顺序对比，只对变化的行发出删除、移动和插入信号
+        new_ids = self.visible_ids()
+        if new_ids == self.ids:
+            return
+        new_pos = {note_id: i for i, note_id in enumerate(new_ids)}
+
+        # 1. 删除已不在列表中的行（连续的行合并，从后往前删除）
+        rows = [row for row, note_id in enumerate(self.ids) if note_id not in new_pos]
+        while rows:
+            last = rows.pop()
+            first = last
+            while rows and rows[-1] == first - 1:
+                first = rows.pop()
+            self.beginRemoveRows(QModelIndex(), first, last)
+            del self.ids[first:last + 1]
+            self.endRemoveRows()
+
+        # 2. 最长递增子序列中的行保持不动，其余的行移动，新便签插入
+        positions = [new_pos[note_id] for note_id in self.ids]
+        stable = {self.ids[i] for i in longest_increasing_subsequence(positions)}
+        changes = len(new_ids) - len(stable)
+        if changes > max(100, len(new_ids) // 4):
+            # 变化太多时直接重置更快
+            self.beginResetModel()
+            self.ids = new_ids
+            self.endResetModel()
+            return
+        current = set(self.ids)
+        for k, note_id in enumerate(new_ids):
+            if note_id in stable:
+                continue
+            # 放在新顺序中前一个便签之后，前一个便签此时已在正确位置
+            dest = self.ids.index(new_ids[k - 1]) + 1 if k > 0 else 0
+            if note_id in current:
+                row = self.ids.index(note_id)
+                if row != dest and row != dest - 1:
+                    self.beginMoveRows(QModelIndex(), row, row, QModelIndex(), dest)
+                    del self.ids[row]
+                    self.ids.insert(dest if dest < row else dest - 1, note_id)
+                    self.endMoveRows()
+            else:
+                self.beginInsertRows(QModelIndex(), dest, dest)
+                self.ids.insert(dest, note_id)
+                self.endInsertRows()
+
+    def note_moved(self, note_id):
+        # 单个便签排序键变化（如置顶）时只移动这一行
+        row = self.row_of(note_id)
+        if row == -1 or note_id not in self.note_data.order:
+            self.sync()
+            return
+        if self.ranked_ids is not None:
+            self.note_changed(note_id)
+            return
+        order = self.note_data.order
+        others = self.ids[:row] + self.ids[row + 1:]
+        new_row = bisect.bisect_left(others, order.index(note_id), key=order.index)
+        if new_row != row:
+            # beginMoveRows 的目标位置按移动前的行号计算
+            dest = new_row if new_row < row else new_row + 1
+            self.beginMoveRows(QModelIndex(), row, row, QModelIndex(), dest)
+            self.ids = others
+            self.ids.insert(new_row, note_id)
+            self.endMoveRows()
+        self.note_changed(note_id)
+
+    def set_filter(self, note_ids):
+        self.filter_ids = note_ids
+        self.ranked_ids = None
+        self.reload()
+
+    def set_ranking(self, note_ids):
+        # note_ids 为按相关度从高到低排列的列表
+        self.filter_ids = set(note_ids)
+        self.ranked_ids = list(note_ids)
+        self.reload()
+
+    def note_added(self, note_id):
+        if self.filter_ids is not None:
+            # 搜索期间新建的便签也要显示出来
+            self.filter_ids.add(note_id)
+        if self.ranked_ids is not None:
+            self.ranked_ids.insert(0, note_id)
+            self.beginInsertRows(QModelIndex(), 0, 0)
+            self.ids.insert(0, note_id)
+            self.endInsertRows()
+            return
+        # self.ids 是显示顺序的子序列，按显示位置二分查找插入点
+        order = self.note_data.order
+        row = bisect.bisect_left(self.ids, order.index(note_id), key=order.index)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.ids.insert(row, note_id)
+        self.endInsertRows()
+
+    def notes_loaded(self, note_ids):
+        # 插入分批加载的便签：按插入点分组，从后往前插入，每组只发一次信号
+        if self.ranked_ids is not None:
+            # 相关度排序的结果由重新查询更新
+            return
+        order = self.note_data.order
+        note_ids = sorted((note_id for note_id in note_ids if self.matches(note_id)), key=order.index)
+        groups = {}
+        for note_id in note_ids:
+            row = bisect.bisect_left(self.ids, order.index(note_id), key=order.index)
+            groups.setdefault(row, []).append(note_id)
+        for row in sorted(groups, reverse=True):
+            group = groups[row]
+            self.beginInsertRows(QModelIndex(), row, row + len(group) - 1)
+            self.ids[row:row] = group
+            self.endInsertRows()
+
+    def note_removed(self, note_id):
+        row = self.row_of(note_id)
+        if row == -1:
+            return
+        self.beginRemoveRows(QModelIndex(), row, row)
+        del self.ids[row]
+        self.endRemoveRows()
+
+    def note_changed(self, note_id):
+        row = self.row_of(note_id)
+        if row != -1:
+            index = self.index(row)
+            self.dataChanged.emit(index, index)
+
+class NoteCardDelegate(QStyledItemDelegate):
+    """按需绘制便签卡片，代替每个便签一个卡片控件"""
+    CARD_HEIGHT = 100
+    CARD_SPACING = 10
+    MARGIN = 5
+    PADDING = 12
+
+    def __init__(self, thumbnails, parent=None):
+        super().__init__(parent)
+        self.thumbnails = thumbnails
+        self.title_font = QFont("Arial", 12, QFont.Bold)
+        self.time_font = QFont()
+        self.time_font.setPixelSize(10)
+        self.content_font = QFont()
+        self.content_font.setPixelSize(11)
+
+    def sizeHint(self, option, index):
+        return QSize(option.rect.width(), self.CARD_HEIGHT + self.CARD_SPACING)
+
+    def paint(self, painter, option, index):
+        note = index.data(NoteListModel.NoteRole)
+        if note is None:
+            return
+        painter.save()
+        painter.setRenderHint(QPainter.Antialiasing)
+        card = option.rect.adjusted(self.MARGIN, self.MARGIN,
+                                    -self.MARGIN, -self.MARGIN - self.CARD_SPACING)
+        hovered = bool(option.state & QStyle.State_MouseOver)
+        painter.setPen(QPen(QColor('#c8dce4')))
+        painter.setBrush(QColor('#d8edf5' if hovered else '#e8f4f8'))
+        painter.drawRoundedRect(card, 10, 10)
+
+        inner = card.adjusted(self.PADDING, self.PADDING, -self.PADDING, -self.PADDING)
+        top = QRect(inner.left(), inner.top(), inner.width(), 22)
+        left = top.left()
+
         # 置顶图标
-        self.pin_label = QLabel("📌")  # 使用UTF-8编码的图标
-        self.pin_label.setStyleSheet("color: #666;")
-        self.pin_label.hide()
-        top_layout.addWidget(self.pin_label)
-        
-        # 标题
-        self.title_label = QLabel(title)
-        self.title_label.setFont(QFont("Arial", 12, QFont.Bold))
-        top_layout.addWidget(self.title_label)
-        
-        # 添加弹性空间
-        top_layout.addStretch()
-        
+        if note.get('is_pinned', False):
+            painter.setPen(QColor('#666'))
+            painter.setFont(self.time_font)
+            painter.drawText(QRect(left, top.top(), 20, top.height()), Qt.AlignVCenter | Qt.AlignLeft, "📌")
+            left += 22
+
         # 时间戳
-        time_label = QLabel(timestamp)
-        time_label.setStyleSheet("color: gray; font-size: 10px;")
-        top_layout.addWidget(time_label)
-        
-        layout.addLayout(top_layout)
-        
-        # 内容限制高度
-        self.content_label = QLabel(content)
-        self.content_label.setWordWrap(True)
-        self.content_label.setStyleSheet("""
-            QLabel {
-                color: #666;
-                font-size: 11px;
-                padding: 5px 0;
-            }
-        """)
-        # 设置固定高度
-        self.content_label.setFixedHeight(40)
-        layout.addWidget(self.content_label)
-        
-        self.setLayout(layout)
-        
-        # 设��便签卡片的固定高度
-        self.setFixedHeight(100)
-        
-        # 设置基本样式
-        self.setStyleSheet("""
-            NoteCard {
-                background-color: #e8f4f8;
-                border-radius: 10px;
-                margin: 5px;
-                padding: 10px;
-            }
-            NoteCard:hover {
-                background-color: #d8edf5;
-            }
-        """)
+        painter.setFont(self.time_font)
+        painter.setPen(QColor('gray'))
+        time_width = painter.fontMetrics().horizontalAdvance(note['timestamp']) + 4
+        painter.drawText(QRect(top.right() - time_width, top.top(), time_width, top.height()),
+                         Qt.AlignVCenter | Qt.AlignRight, note['timestamp'])
 
-    def mouseDoubleClickEvent(self, event):
-        self.note_clicked.emit(self.note_id, self.title, self.content)
+        # 标题
+        painter.setFont(self.title_font)
+        painter.setPen(QColor('black'))
+        title_rect = QRect(left, top.top(), top.right() - time_width - left - 6, top.height())
+        title = painter.fontMetrics().elidedText(note['title'], Qt.ElideRight, title_rect.width())
+        painter.drawText(title_rect, Qt.AlignVCenter | Qt.AlignLeft, title)
 
-    def show_context_menu(self, position):
-        menu = QMenu(self)
-        
-        edit_action = menu.addAction("编辑")
-        delete_action = menu.addAction("删除")
-        pin_action = menu.addAction("取消置顶" if self.is_pinned else "置顶")
-        
-        action = menu.exec_(self.mapToGlobal(position))
-        
-        if action == edit_action:
-            self.note_clicked.emit(self.note_id, self.title, self.content)
-        elif action == delete_action:
-            reply = QMessageBox.question(self, '确认删除', 
-                                       '确定要删除这个便签吗？',
-                                       QMessageBox.Yes | QMessageBox.No,
-                                       QMessageBox.No)
-            if reply == QMessageBox.Yes:
-                self.note_deleted.emit(self.note_id)
-        elif action == pin_action:
-            self.is_pinned = not self.is_pinned
-            self.pin_label.setVisible(self.is_pinned)
-            self.note_pinned.emit(self.note_id, self.is_pinned)
+        # 内容预览，限制在固定高度内
+        content_rect = QRect(inner.left(), top.bottom() + 5, inner.width(), CARD_IMAGE_SIZE)
+        image_path = index.data(NoteListModel.ImageRole)
+        if image_path:
+            # 第一张图片的缩略图显示在预览右侧，加载完成前显示占位框
+            image = self.thumbnails.request(image_path, CARD_IMAGE_SIZE, CARD_IMAGE_SIZE)
+            if image is None:
+                image_rect = QRect(content_rect.right() - CARD_IMAGE_SIZE + 1, content_rect.top(),
+                                   CARD_IMAGE_SIZE, CARD_IMAGE_SIZE)
+                painter.fillRect(image_rect, QColor('#dde8ec'))
+            else:
+                image_rect = QRect(content_rect.right() - image.width() + 1, content_rect.top(),
+                                   image.width(), image.height())
+                painter.drawImage(image_rect, image)
+            content_rect.setRight(image_rect.left() - 8)
+        painter.setClipRect(content_rect)
+        painter.setFont(self.content_font)
+        painter.setPen(QColor('#666'))
+        painter.drawText(content_rect, Qt.AlignTop | Qt.AlignLeft | Qt.TextWordWrap,
+                         index.data(NoteListModel.PreviewRole))
+        painter.restore()
+
+class SearchWorker(QObject):
+    """在后台线程中执行搜索，输入变化后过期的查询直接丢弃"""
+    results_ready = pyqtSignal(int, str, object)  # 查询序号, 查询文本, 结果ID集合或排序后的列表
+
+    def __init__(self, note_data):
+        super().__init__()
+        self.note_data = note_data
+        # 最新的查询序号，由界面线程更新
+        self.latest = 0
+
+    @pyqtSlot(int, str, bool)
+    def run_query(self, seq, text, ranked):
+        if seq != self.latest:
+            return
+        def is_cancelled():
+            return seq != self.latest
+        if ranked:
+            note_ids = self.note_data.rank_ids(text, is_cancelled=is_cancelled)
+        else:
+            note_ids = self.note_data.search_ids(text, is_cancelled)
+        if note_ids is not None and seq == self.latest:
+            self.results_ready.emit(seq, text, note_ids)
 
 class StickyNoteApp(QMainWindow):
+    notes_saved = pyqtSignal()  # 后台写入完成
+    save_failed = pyqtSignal(str)  # 后台写入失败，参数为错误信息
+    search_requested = pyqtSignal(int, str, bool)  # 查询序号, 查询文本, 是否按相关度排序
+    garbage_collected = pyqtSignal(object)  # 后台清理完成，参数为清理报告
+    search_index_loaded = pyqtSignal()  # 持久化的全文索引已在后台读取完成
+
     def __init__(self):
         super().__init__()
         self.note_data = NoteData()
+        # 写入回调在后台线程中调用，通过信号转到界面线程处理
+        self.note_data.set_save_callbacks(self.notes_saved.emit, self.save_failed.emit)
+        self.notes_saved.connect(self.on_notes_saved)
+        self.save_failed.connect(self.show_save_error)
+        self.save_error_shown = False
+        self.init_search()
+        # 退出时确保所有修改都已写入
+        QApplication.instance().aboutToQuit.connect(self.stop_search)
+        QApplication.instance().aboutToQuit.connect(self.note_data.close)
+        # 编辑器、图片查看器和卡片预览共用的缩略图缓存
+        self.thumbnails = ThumbnailCache(os.path.join(self.note_data.data_dir, 'thumbs'),
+                                         self.note_data.images_dir, parent=self)
+        QApplication.instance().aboutToQuit.connect(self.thumbnails.stop)
+        self.garbage_collected.connect(self.on_garbage_collected)
+        self.search_index_loaded.connect(self.on_search_index_loaded)
         self.is_window_pinned = False
         self.window_opacity = 1.0
         self.initUI()
         self.load_saved_notes()
         self.setCursor(Qt.ArrowCursor)
         
+    def init_search(self):
+        self.search_text = ''
+        # False 时在原有顺序中过滤，True 时按相关度显示前 SEARCH_RANK_LIMIT 个结果
+        self.search_ranked = False
+        # 每次输入变化序号加一，用于丢弃过期的查询结果
+        self.search_seq = 0
+        # 查询发出后加载的便签，结果返回时补充过滤
+        self.loaded_since_search = []
+        # 输入停止一段时间后才查询
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(SEARCH_DELAY_MS)
+        self.search_timer.timeout.connect(self.run_search)
+        # 搜索在独立线程中执行
+        self.search_thread = QThread(self)
+        self.search_worker = SearchWorker(self.note_data)
+        self.search_worker.moveToThread(self.search_thread)
+        self.search_requested.connect(self.search_worker.run_query)
+        self.search_worker.results_ready.connect(self.apply_search_results)
+        self.search_thread.start()
+
+    def stop_search(self):
+        self.search_worker.latest = -1
+        self.search_thread.quit()
+        self.search_thread.wait()
+
     def initUI(self):
         self.setWindowTitle('久久便签-by 微信779059811')
         # 调整窗口宽度确保内容完全显示
@@ -734,26 +4580,43 @@ class StickyNoteApp(QMainWindow):
         search_box.setPlaceholderText("搜索...")
         search_box.textChanged.connect(self.search_notes)
         search_layout.addWidget(search_box)
+
+        self.rank_button = QPushButton("⇅")
+        self.rank_button.setCheckable(True)
+        self.rank_button.setToolTip("按相关度排序搜索结果")
+        self.rank_button.toggled.connect(self.toggle_search_ranking)
+        self.rank_button.setCursor(Qt.ArrowCursor)
+        search_layout.addWidget(self.rank_button)
         
         main_layout.addWidget(search_widget)
         
         # 便签列表区域
-        scroll = QScrollArea()
-        scroll.setWidgetResizable(True)
-        scroll.setStyleSheet("QScrollArea { border: none; }")
-        
-        # 创建个容器widget来包含所有内容
         self.container_widget = QWidget()
         self.container_layout = QVBoxLayout(self.container_widget)
-        self.container_layout.setAlignment(Qt.AlignTop)
-        
-        # 便签列表容器
-        notes_widget = QWidget()
-        self.notes_layout = QVBoxLayout(notes_widget)
-        self.notes_layout.setAlignment(Qt.AlignTop)
-        self.notes_layout.setSpacing(10)
-        self.container_layout.addWidget(notes_widget)
-        
+        self.container_layout.setContentsMargins(0, 0, 0, 0)
+
+        self.notes_model = NoteListModel(self.note_data, self)
+        self.notes_view = QListView()
+        self.notes_view.setModel(self.notes_model)
+        self.notes_view.setItemDelegate(NoteCardDelegate(self.thumbnails, self.notes_view))
+        # 卡片缩略图加载完成后重绘
+        self.thumbnails.image_ready.connect(lambda *args: self.notes_view.viewport().update())
+        # 所有行高度相同，视图无需逐行计算尺寸
+        self.notes_view.setUniformItemSizes(True)
+        # 大量便签时分批布局，避免阻塞界面
+        self.notes_view.setLayoutMode(QListView.Batched)
+        self.notes_view.setBatchSize(200)
+        self.notes_view.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+        self.notes_view.verticalScrollBar().setSingleStep(20)
+        self.notes_view.setSelectionMode(QAbstractItemView.NoSelection)
+        self.notes_view.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.notes_view.setMouseTracking(True)
+        self.notes_view.setStyleSheet("QListView { border: none; background: transparent; padding: 5px; }")
+        self.notes_view.setContextMenuPolicy(Qt.CustomContextMenu)
+        self.notes_view.customContextMenuRequested.connect(self.show_note_context_menu)
+        self.notes_view.doubleClicked.connect(self.open_note)
+        self.container_layout.addWidget(self.notes_view)
+
         # 添加空状态提示标签
         self.empty_label = QLabel('点击上方"+"创建便签')
         self.empty_label.setAlignment(Qt.AlignCenter)
@@ -766,48 +4629,113 @@ class StickyNoteApp(QMainWindow):
         """)
         # 初始时将空状态标签隐藏
         self.empty_label.hide()
-        
-        # 创建一个占位的弹性空间，用于将空状态标签居中
-        self.container_layout.addStretch(1)
-        self.container_layout.addWidget(self.empty_label, 0, Qt.AlignCenter)
-        self.container_layout.addStretch(1)
-        
-        scroll.setWidget(self.container_widget)
-        main_layout.addWidget(scroll)
-         
-                
+        self.container_layout.addWidget(self.empty_label)
+
+        main_layout.addWidget(self.container_widget)
+
+        # 状态栏只在有提示时显示
+        status_bar = self.statusBar()
+        status_bar.setStyleSheet("QStatusBar { background-color: #f8f8f8; color: #666; }")
+        status_bar.messageChanged.connect(lambda message: status_bar.setVisible(bool(message)))
+        status_bar.hide()
+
     def load_saved_notes(self):
-        for note in self.note_data.notes:
-            self.add_note(
-                note['title'],
-                note['content'],
-                note['timestamp'],
-                note['id'],
-                note.get('is_pinned', False)
-            )
+        # 批量加载：排序只在建立索引时做一次，列表整体重置一次，期间暂停视图刷新
+        self.notes_view.setUpdatesEnabled(False)
+        self.notes_model.reload()
+        self.update_empty_state()
+        self.notes_view.setUpdatesEnabled(True)
+        # 已加载第一屏，其余便签在事件循环空闲时分批加载
+        self.load_timer = QTimer(self)
+        self.load_timer.timeout.connect(self.load_next_notes)
+        self.load_timer.start(0)
+        # 窗口显示之后再在后台读取持久化的全文索引
+        QTimer.singleShot(0, lambda: self.note_data.load_search_index(
+            on_done=self.search_index_loaded.emit))
+
+    def on_search_index_loaded(self):
+        self.note_data.adopt_search_index()
+        # 持久化的索引中没有当前文本的便签需要补全
+        if not self.load_timer.isActive():
+            self.load_timer.start(0)
+        if self.search_text:
+            # 此前的结果来自逐个扫描，有索引后按相关度重新查询
+            self.search_timer.start()
+
+    def load_next_notes(self):
+        note_ids = self.note_data.load_more()
+        if note_ids is None:
+            # 全部加载后，继续在空闲时为旧便签补全纯文本和预览
+            note_ids = self.note_data.backfill()
+            if not self.note_data.underived:
+                self.load_timer.stop()
+                # 加载和补全都已完成，清理过期的已删除便签和不再使用的图片；
+                # 全文索引尚未读取完成时，读取完成后还要补全，届时再清理
+                if self.note_data.index_ready:
+                    self.note_data.collect_garbage(thumbs_dir=self.thumbnails.thumbs_dir,
+                                                   on_done=self.garbage_collected.emit)
+            if note_ids and self.search_text:
+                # 刚补全的便签此前不在索引中，单独参与过滤
+                self.notes_model.notes_loaded(self.search_new_notes(note_ids))
+            return
+        if not note_ids:
+            return
+        if self.search_text:
+            # 正在搜索时，新加载的便签也要参与过滤
+            self.search_new_notes(note_ids)
+        self.notes_model.notes_loaded(note_ids)
+        self.update_empty_state()
+
+    def search_new_notes(self, note_ids):
+        # 后台查询可能没有覆盖这些便签，结果返回时再合并一次；返回新匹配的便签ID
+        if self.search_ranked:
+            # 相关度需要和已有结果一起重新计算，等加载告一段落后重新查询
+            self.search_timer.start()
+            return []
+        self.loaded_since_search.extend(note_ids)
+        filter_ids = self.notes_model.filter_ids
+        if filter_ids is None:
+            return []
+        results = self.note_data.search_notes(self.search_text, note_ids)
+        new_ids = [note['id'] for note in results if note['id'] not in filter_ids]
+        filter_ids.update(new_ids)
+        return new_ids
     
-    def add_note(self, title, content, timestamp, note_id=None, is_pinned=False):
-        if note_id is None:
-            note = self.note_data.add_note(title, content, timestamp)
-            note_id = note['id']
-            is_pinned = note.get('is_pinned', False)
-        else:
-            note = next((n for n in self.note_data.notes if n['id'] == note_id), None)
-            if note:
-                is_pinned = note.get('is_pinned', False)
-            else:
-                is_pinned = False
+    def add_note(self, title, content, timestamp):
+        note = self.note_data.add_note(title, content, timestamp)
+        self.notes_model.note_added(note['id'])
+        self.update_empty_state()
+
+    def open_note(self, index):
+        note = index.data(NoteListModel.NoteRole)
+        if note is not None:
+            self.edit_note(note['id'], note['title'], self.note_data.note_content(note['id']))
+
+    def show_note_context_menu(self, position):
+        index = self.notes_view.indexAt(position)
+        note = index.data(NoteListModel.NoteRole) if index.isValid() else None
+        if note is None:
+            return
+        is_pinned = note.get('is_pinned', False)
+        menu = QMenu(self)
         
-        note_card = NoteCard(note_id, title, content, timestamp)
-        note_card.is_pinned = is_pinned
-        note_card.pin_label.setVisible(is_pinned)
-        note_card.note_clicked.connect(self.edit_note)
-        note_card.note_deleted.connect(self.delete_note)
-        note_card.note_pinned.connect(self.toggle_pin_note)
+        edit_action = menu.addAction("编辑")
+        delete_action = menu.addAction("删除")
+        pin_action = menu.addAction("取消置顶" if is_pinned else "置顶")
         
-        self.notes_layout.insertWidget(0, note_card)
-        self.update_empty_state()
-        self.reorder_notes()
+        action = menu.exec_(self.notes_view.viewport().mapToGlobal(position))
+        
+        if action == edit_action:
+            self.edit_note(note['id'], note['title'], self.note_data.note_content(note['id']))
+        elif action == delete_action:
+            reply = QMessageBox.question(self, '确认删除', 
+                                       '确定要删除这个便签吗？',
+                                       QMessageBox.Yes | QMessageBox.No,
+                                       QMessageBox.No)
+            if reply == QMessageBox.Yes:
+                self.delete_note(note['id'])
+        elif action == pin_action:
+            self.toggle_pin_note(note['id'], not is_pinned)
     
     def add_new_note(self):
         timestamp = datetime.now().strftime("%H:%M")
@@ -881,110 +4809,71 @@ class StickyNoteApp(QMainWindow):
             # 更新数据存储
             if self.note_data.update_note(note_id, new_title, new_content):
                 # 更新UI
-                for i in range(self.notes_layout.count()):
-                    widget = self.notes_layout.itemAt(i).widget()
-                    if isinstance(widget, NoteCard) and widget.note_id == note_id:
-                        widget.title = new_title
-                        widget.content = new_content
-                        widget.title_label.setText(new_title)
-                        widget.content_label.setText(new_content)
-                        break
+                self.notes_model.note_changed(note_id)
     
     def search_notes(self, text):
+        self.search_text = text
+        # 使正在执行的查询失效
+        self.search_seq += 1
+        self.search_worker.latest = self.search_seq
         if not text:
             # 显示所有便签
-            for i in range(self.notes_layout.count()):
-                self.notes_layout.itemAt(i).widget().show()
+            self.search_timer.stop()
+            self.notes_model.set_filter(None)
             return
-        
-        # 搜索并只显示匹配的便签
-        results = self.note_data.search_notes(text)
-        result_ids = [note['id'] for note in results]
-        
-        for i in range(self.notes_layout.count()):
-            widget = self.notes_layout.itemAt(i).widget()
-            if isinstance(widget, NoteCard):
-                widget.setVisible(widget.note_id in result_ids)
+        self.search_timer.start()
+
+    def toggle_search_ranking(self, ranked):
+        self.search_ranked = ranked
+        self.search_notes(self.search_text)
+
+    def run_search(self):
+        # 后台线程只查索引，尚未补全的旧便签由空闲补全时再加入结果
+        self.loaded_since_search = []
+        self.search_requested.emit(self.search_seq, self.search_text, self.search_ranked)
+
+    def apply_search_results(self, seq, text, note_ids):
+        if seq != self.search_seq:
+            return
+        if self.search_ranked:
+            # 查询后新加载的便签由 search_new_notes 触发重新查询
+            self.notes_model.set_ranking(note_ids)
+            return
+        if self.loaded_since_search:
+            results = self.note_data.search_notes(text, self.loaded_since_search)
+            note_ids = note_ids | {note['id'] for note in results}
+            self.loaded_since_search = []
+        # 搜索并只显示匹配的便签，结果一次性应用到列表
+        self.notes_model.set_filter(note_ids)
 
     def delete_note(self, note_id):
         self.note_data.delete_note(note_id)
         # 从UI中移除便签
-        for i in range(self.notes_layout.count()):
-            widget = self.notes_layout.itemAt(i).widget()
-            if isinstance(widget, NoteCard) and widget.note_id == note_id:
-                widget.deleteLater()
-                break
+        self.notes_model.note_removed(note_id)
         self.update_empty_state()
 
     def toggle_pin_note(self, note_id, is_pinned):
         if self.note_data.update_note_pin_status(note_id, is_pinned):
-            self.reorder_notes()
+            # 只有这一个便签的位置发生变化
+            self.notes_model.note_moved(note_id)
 
     def reorder_notes(self):
-        # 获取排序后的便签数据
-        ordered_notes = self.note_data.get_notes_ordered()
-        
-        # 临时存储所有便签卡片
-        current_cards = {}
-        cards_to_remove = []
-        
-        # 收集所有便签卡片
-        for i in range(self.notes_layout.count()):
-            widget = self.notes_layout.itemAt(i).widget()
-            if isinstance(widget, NoteCard):
-                current_cards[widget.note_id] = widget
-                cards_to_remove.append(widget)
-        
-        # 从布局中移除所有便签卡片
-        for card in cards_to_remove:
-            self.notes_layout.removeWidget(card)
-            card.setParent(None)
-        
-        # 按新顺序重新添加便签卡片（从后往前添加，这样最新的会在最上面）
-        for note in reversed(ordered_notes):
-            note_id = note['id']
-            if note_id in current_cards:
-                card = current_cards[note_id]
-                card.is_pinned = note.get('is_pinned', False)
-                card.pin_label.setVisible(card.is_pinned)
-                self.notes_layout.insertWidget(0, card)  # 插入到最顶端
-        
+        # 按排序后的便签数据更新列表，只移动位置变化的行
+        self.notes_model.sync()
         # 新空状态显示
         self.update_empty_state()
-        
-        # 强制更新布局
-        self.container_layout.update()
-        self.notes_layout.update()
 
     def handle_note_reorder(self, source_id, target_id):
         self.note_data.reorder_notes(source_id, target_id)
         self.reorder_notes()
 
     def update_empty_state(self):
-        # 检查是否有便签
-        has_notes = False
-        for i in range(self.notes_layout.count()):
-            widget = self.notes_layout.itemAt(i).widget()
-            if isinstance(widget, NoteCard):
-                has_notes = True
-                break
+        # 检查是否有便签（搜索无结果时不显示空状态提示）
+        has_notes = len(self.note_data.order) > 0
         
-        # 显示或隐藏空状态提示和弹性空间
+        # 显示或隐藏空状态提示
+        self.notes_view.setVisible(has_notes)
         self.empty_label.setVisible(not has_notes)
-        
-        # 更新布局中的弹性空间
-        if has_notes:
-            # 有便签时，移除弹性空间，让便签紧凑排列
-            self.container_layout.setStretch(0, 1)  # 便签区域占满
-            self.container_layout.setStretch(1, 0)  # 上部弹性空间
-            self.container_layout.setStretch(2, 0)  # 空状态标签
-            self.container_layout.setStretch(3, 0)  # 下部弹性空间
-        else:
-            # 没有便签时，加弹性空间使空状态标签居中
-            self.container_layout.setStretch(0, 0)  # 便签区域
-            self.container_layout.setStretch(1, 1)  # 上部弹性空间
-            self.container_layout.setStretch(2, 0)  # 空状态标签
-            self.container_layout.setStretch(3, 1)  # 下部弹性空间
 
     def toggle_window_pin(self):
         self.is_window_pinned = not self.is_window_pinned
@@ -996,8 +4885,31 @@ class StickyNoteApp(QMainWindow):
         self.window_opacity = value / 100
         self.setWindowOpacity(self.window_opacity)
 
+    def on_notes_saved(self):
+        self.save_error_shown = False
+
+    def on_garbage_collected(self, report):
+        if report['purged_notes'] or report['removed_files'] or report['thinned_revisions']:
+            self.show_status(
+                f"已清理 {report['purged_notes']} 个过期便签（{format_bytes(report['note_bytes'])}）、"
+                f"{report['removed_files']} 个无用文件（{format_bytes(report['freed_bytes'])}），"
+                f"精简 {report['thinned_revisions']} 个历史版本")
+
+    def show_status(self, message):
+        # 临时提示显示在窗口底部，消失后状态栏随之隐藏
+        status_bar = self.statusBar()
+        status_bar.showMessage(message, STATUS_MESSAGE_MS)
+        status_bar.show()
+
+    def show_save_error(self, message):
+        # 写入恢复前只提示一次
+        if self.save_error_shown:
+            return
+        self.save_error_shown = True
+        QMessageBox.warning(self, "错误", f"保存便签时出错：{message}")
+
 class ImageViewer(QDialog):
-    def __init__(self, image_path):
+    def __init__(self, image_path, thumbnails):
         super().__init__()
         self.setWindowTitle("图片查看")
         self.setWindowFlags(Qt.Window | Qt.WindowCloseButtonHint)
@@ -1008,20 +4920,22 @@ class ImageViewer(QDialog):
         scroll = QScrollArea()
         scroll.setWidgetResizable(True)
         
-        # 加载原始图片
-        label = QLabel()
-        pixmap = QPixmap(image_path)
-        
         # 获取屏幕尺寸
         screen = QApplication.desktop().screenGeometry()
         max_width = screen.width() * 0.8
         max_height = screen.height() * 0.8
         
-        # 如果图片超过屏幕80%的大小，则等比例缩放
-        if pixmap.width() > max_width or pixmap.height() > max_height:
-            pixmap = pixmap.scaled(int(max_width), int(max_height), Qt.KeepAspectRatio, Qt.SmoothTransformation)
-        
-        label.setPixmap(pixmap)
+        # 如果图片超过屏幕80%的大小，则使用缓存中等比例缩小的副本；
+        # 后台解码期间先显示占位文字，尺寸从文件头读取
+        self.label = QLabel("加载中...")
+        self.label.setAlignment(Qt.AlignCenter)
+        self.image_path = image_path
+        self.thumbnails = thumbnails
+        self.bounds = (int(max_width), int(max_height))
+        size = QImageReader(image_path).size()
+        if size.width() > max_width or size.height() > max_height:
+            size = size.scaled(self.bounds[0], self.bounds[1], Qt.KeepAspectRatio)
+        label = self.label
         scroll.setWidget(label)
         
         layout.addWidget(scroll)
@@ -1052,10 +4966,38 @@ class ImageViewer(QDialog):
         self.setLayout(layout)
         
         # 设置窗口大小
-        self.resize(min(pixmap.width() + 40, int(max_width)),
-                   min(pixmap.height() + 80, int(max_height)))
+        self.resize(min(max(size.width(), 200) + 40, int(max_width)),
+                   min(max(size.height(), 100) + 80, int(max_height)))
+        
+        image = thumbnails.request(image_path, *self.bounds)
+        if image is None:
+            thumbnails.image_ready.connect(self.on_image_ready)
+            thumbnails.image_failed.connect(self.on_image_failed)
+        else:
+            self.label.setPixmap(QPixmap.fromImage(image))
+
+    def on_image_ready(self, path, width, height):
+        if path != self.image_path or (width, height) != self.bounds:
+            return
+        image = self.thumbnails.request(path, width, height)
+        if image is not None:
+            # 只在界面线程中转换为 QPixmap
+            self.label.setPixmap(QPixmap.fromImage(image))
+
+    def on_image_failed(self, path, width, height):
+        if path == self.image_path and (width, height) == self.bounds:
+            self.label.setText("无法加载图片，文件可能已损坏")
 
 if __name__ == '__main__':
+    # 打包后的程序中，处理图片的子进程需要
+    multiprocessing.freeze_support()
+    if len(sys.argv) == 3 and sys.argv[1] == '--export-json':
+        # 调试用：python notedesk2.py --export-json 文件名，导出全部便签（含正文）
+        storage = open_storage(os.path.join(os.path.expanduser('~'), 'NoteDesk'))
+        count = storage.export_json(sys.argv[2])
+        storage.close()
+        print(f"Exported {count} notes to {sys.argv[2]}")
+        sys.exit(0)
     app = QApplication(sys.argv)
     ex = StickyNoteApp()
     ex.show()
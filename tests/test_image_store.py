@@ -0,0 +1,82 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PyQt5.QtGui import QTextDocument, QTextCursor, QTextImageFormat
+
+import notedesk2
+
+
+class ImageNamesTest(unittest.TestCase):
+    """路径中含有 & 等字符时，便签内容中的图片仍能被识别"""
+
+    def setUp(self):
+        self.home = tempfile.TemporaryDirectory()
+        self.images_dir = os.path.join(self.home.name, 'Tom & Jerry', 'images')
+        os.makedirs(self.images_dir)
+        self.store = notedesk2.ImageStore(self.images_dir)
+
+    def tearDown(self):
+        self.home.cleanup()
+
+    def test_escaped_src(self):
+        path = os.path.join(self.images_dir, 'a.png').replace('&', '&amp;')
+        self.assertEqual(self.store.image_names(f'<img src="{path}" />'), ['a.png'])
+
+    def test_file_url(self):
+        url = 'file://' + os.path.join(self.images_dir, 'b c.png').replace(' ', '%20').replace('&', '%26')
+        self.assertEqual(self.store.image_names(f'<img src="{url}" />'), ['b c.png'])
+
+    def test_qt_html(self):
+        # toHtml() 写出的内容
+        document = QTextDocument()
+        image_format = QTextImageFormat()
+        image_format.setName(os.path.join(self.images_dir, 'c.png'))
+        QTextCursor(document).insertImage(image_format)
+        self.assertEqual(self.store.image_names(document.toHtml()), ['c.png'])
+
+
+class CollectGarbageTest(unittest.TestCase):
+    """清理不会删除仍被便签引用的图片"""
+
+    def setUp(self):
+        self.home = tempfile.TemporaryDirectory()
+        home = os.path.join(self.home.name, 'Tom & Jerry')
+        os.makedirs(home)
+        self.patch = mock.patch.dict(os.environ, {'HOME': home})
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        self.home.cleanup()
+
+    def test_referenced_image_kept(self):
+        data = notedesk2.NoteData('json')
+        used = os.path.join(data.images_dir, 'used.png')
+        unused = os.path.join(data.images_dir, 'unused.png')
+        old = time.time() - 2 * notedesk2.GC_IMAGE_GRACE
+        for path in (used, unused):
+            with open(path, 'wb') as f:
+                f.write(b'x' * 100)
+            os.utime(path, (old, old))
+        document = QTextDocument()
+        image_format = QTextImageFormat()
+        image_format.setName(used)
+        QTextCursor(document).insertImage(image_format)
+        note = data.add_note('title', document.toHtml(), 0)
+        self.assertEqual(list(data.get_note(note['id'])['images']), ['used.png'])
+        reports = []
+        data.collect_garbage(on_done=reports.append).join()
+        data.close()
+        self.assertTrue(os.path.exists(used))
+        self.assertFalse(os.path.exists(unused))
+        self.assertEqual(reports[0]['removed_files'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()